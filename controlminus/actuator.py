@@ -0,0 +1,205 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Write-through cache of actuator (motor) state.
+
+Each BLE write costs time and bandwidth, yet control code tends to repeat
+commands - joystick jitter within the deadband sends `set_speed(0)` over
+and over to motors that are already stopped. `Actuators` remembers the
+last command each motor acknowledged (i.e., the BLE write completed) and
+skips writes that would not change hub's state.
+
+A command is then outstanding until motor's feedback (sensor values)
+confirms it. If it is not confirmed within `Actuators.timeout` seconds
+(for example, the hub dropped it or motor stalled), the cached state is
+forgotten so the next command is written even if it is the same.
+"""
+from time import monotonic
+
+from controlminus.stats import RunningStats
+
+
+def sgn(value):
+    if value < 0:
+        return -1
+    elif value == 0:
+        return 0
+    else:
+        return 1
+
+
+class Port:
+    """
+    Cached state of one motor.
+    """
+    def __init__(self):
+        self.command = None     # last acknowledged command, a (kind, value) tuple
+        self.pending = None     # command being written
+        self.sent = 0           # time `command` was acknowledged
+        self.confirmed = False  # True if feedback confirmed `command`
+
+
+class Actuators:
+    # Seconds to wait for feedback confirming a command
+    timeout = 1.0
+
+    # Tolerance (in degrees) when confirming `set_pos()`
+    tolerance = 5
+
+    def __init__(self):
+        self._ports = {}
+        self.writes = 0
+        self.skipped = 0
+        self.unconfirmed = 0
+        # Time (in seconds) BLE writes take to complete
+        self.latency = RunningStats()
+
+    @property
+    def outstanding(self):
+        """
+        Number of commands not (yet) confirmed by feedback.
+        """
+        return len([port for port in self._ports.values() if port.command != None and not port.confirmed])
+
+    def invalidate(self, motor=None):
+        """
+        Forget cached state of given motor (or all motors), i.e., when
+        motor is commanded directly (bypassing the cache) or hub
+        (re)connects.
+        """
+        for each, port in self._ports.items():
+            if motor == None or motor == each:
+                port.command = None
+                port.confirmed = False
+
+    async def set_speed(self, motor, speed):
+        await self._write(motor, ('speed', speed), motor.set_speed, speed)
+
+    async def set_pos(self, motor, pos, speed=50, max_power=50):
+        await self._write(motor, ('pos', pos), motor.set_pos, pos, speed=speed, max_power=max_power)
+
+    def _port(self, motor):
+        port = self._ports.get(motor)
+        if port == None:
+            port = self._ports[motor] = Port()
+            motor.connect('notify', self.on_feedback)
+        return port
+
+    async def _write(self, motor, command, write, *args, **kwargs):
+        port = self._port(motor)
+        if command == port.pending or (port.pending == None and command == port.command):
+            self.skipped += 1
+            return
+        port.pending = command
+        self.writes += 1
+        started = monotonic()
+        try:
+            await write(*args, **kwargs)
+        except:
+            port.pending = None
+            port.command = None
+            raise
+        if port.pending == command:
+            port.pending = None
+        port.command = command
+        port.sent = monotonic()
+        self.latency.add(port.sent - started)
+        port.confirmed = False
+        self.on_feedback(motor)
+
+    def on_feedback(self, motor):
+        port = self._ports[motor]
+        if port.command == None or port.confirmed:
+            return
+        kind, value = port.command
+        if kind == 'speed':
+            measured = getattr(motor, 'sense_speed', None)
+            confirmed = measured == None or sgn(measured) == sgn(value)
+        else:
+            measured = getattr(motor, 'sense_pos', None)
+            confirmed = measured == None or abs(measured - value) <= self.tolerance
+        if confirmed:
+            port.confirmed = True
+        elif monotonic() - port.sent > self.timeout:
+            port.command = None
+            self.unconfirmed += 1
+
+
+if __name__ == '__main__':
+    # Replay commanded speed and steering from a recorded telemetry file
+    # (see controlminus.export) or from a synthetic joystick trace on
+    # simulated vehicle, with and without the cache and report number of
+    # BLE writes:
+    #
+    #     python3 -m controlminus.actuator [TRACE]
+    #
+    import sys
+    import asyncio
+    from math import sin
+    from random import Random
+    from controlminus.simulator import SimulatedVehicle
+
+    def load_trace(path):
+        import pyarrow
+        import pyarrow.parquet
+        if path.endswith(('.parquet', '.pq')):
+            table = pyarrow.parquet.read_table(path)
+        else:
+            table = pyarrow.ipc.open_file(path).read_all()
+        trace = []
+        for row in table.to_pylist():
+            if row['channel'] in ('vehicle.speed', 'vehicle.steering'):
+                trace.append((row['time'], row['channel'][8:], int(row['value'])))
+        return trace
+
+    def synthetic_trace(seconds=600, rate=50):
+        # Thumbstick resting in the center with some jitter, occasionally
+        # pushed to drive.
+        random = Random(42)
+        trace = []
+        for i in range(seconds * rate):
+            t = i / rate
+            driving = sin(t / 20) > 0.5
+            speed = int(60 * sin(t / 3)) if driving else 0
+            steering = int(80 * sin(t / 2)) if driving else 0
+            trace.append((t, 'speed', speed + random.randint(-8, 8)))
+            trace.append((t, 'steering', steering + random.randint(-8, 8)))
+        return trace
+
+    async def replay(trace, actuators):
+        vehicle = SimulatedVehicle(actuators=actuators)
+        for t, name, value in trace:
+            if name == 'speed':
+                await vehicle.set_speed(value)
+            else:
+                await vehicle.set_steering(value)
+            vehicle.step(0.01)
+        return vehicle
+
+    trace = load_trace(sys.argv[1]) if len(sys.argv) > 1 else synthetic_trace()
+    loop = asyncio.get_event_loop()
+    before = loop.run_until_complete(replay(trace, False))
+    after = loop.run_until_complete(replay(trace, True))
+    for name in ('motor_a', 'motor_b', 'steering'):
+        print("I: %-8s: %6d BLE writes without cache, %6d with cache" % (name, before.peripherals[name].writes, after.peripherals[name].writes))
+    print("I: total   : %6d BLE writes without cache, %6d with cache (%d commands, %d skipped, %d unconfirmed)" % (
+        sum(before.peripherals[name].writes for name in ('motor_a', 'motor_b', 'steering')),
+        after.actuators.writes, len(trace), after.actuators.skipped, after.actuators.unconfirmed))
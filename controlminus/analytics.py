@@ -0,0 +1,323 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Offload heavy telemetry analytics to worker processes.
+
+`AnalyticsExecutor` collects vehicle's sensor samples into batches kept
+in shared memory. Once a batch is full, it is handed over to a pool of
+worker processes which run all subscribed analyses on it and results are
+passed back to subscribers' callbacks in vehicle's event loop. Samples
+are not copied nor pickled, workers map the batch directly. Usage:
+
+    analytics = AnalyticsExecutor(vehicle)
+    analytics.subscribe(channel_statistics, on_statistics)
+    analytics.start()
+    ...
+    await analytics.stop()
+
+An analysis is a (module-level, so it can be pickled) function called
+as `analysis(times, channels, values, names)` where first three are
+memoryviews of doubles - sample times, channel indices (into `names`)
+and values - and `names` is a list of channel names. It must not keep
+references to the memoryviews. Its result must be picklable.
+
+Like exporter, executor drops batches (and counts dropped samples) if
+workers cannot keep up rather than let them pile up.
+"""
+import logging
+import os
+
+from asyncio import get_event_loop, gather
+from concurrent.futures import ProcessPoolExecutor
+from math import sqrt
+from multiprocessing import get_context, shared_memory
+from time import time
+
+from controlminus.telemetry import peripherals, channels, channel_names, values
+from controlminus.shm import map_segment
+
+logger = logging.getLogger(__name__)
+
+
+def channel_statistics(times, channels, values, names):
+    """
+    Analysis computing (count, mean, stddev, min, max) of values of each
+    channel in a batch. Return dictionary of channel names to these.
+    """
+    sums = {}
+    for channel, value in zip(channels, values):
+        if value != value:
+            continue
+        s = sums.get(channel)
+        if s == None:
+            sums[channel] = [1, value, value * value, value, value]
+        else:
+            s[0] += 1
+            s[1] += value
+            s[2] += value * value
+            if value < s[3]:
+                s[3] = value
+            elif value > s[4]:
+                s[4] = value
+    result = {}
+    for channel, (count, total, squares, minimum, maximum) in sums.items():
+        mean = total / count
+        result[names[int(channel)]] = (count, mean, sqrt(max(0.0, squares / count - mean * mean)), minimum, maximum)
+    return result
+
+
+def _analyze(name, capacity, n, analyses, names):
+    """
+    Run given analyses over a batch in shared memory segment `name`.
+    Runs in worker process.
+    """
+    segment = map_segment(name)
+    try:
+        with memoryview(segment) as raw, raw.cast('d') as buf, \
+                buf[0:n] as times, buf[capacity:capacity + n] as channels, buf[2 * capacity:2 * capacity + n] as values:
+            return [analysis(times, channels, values, names) for analysis in analyses]
+    finally:
+        segment.close()
+
+
+class AnalyticsExecutor:
+    """
+    Runs analyses over batches of `batch_size` samples of given vehicle's
+    telemetry in `workers` processes (defaults to number of CPUs), at most
+    `max_pending` batches at a time (defaults to twice the number of
+    workers). If `workers` is 0, analyses run in the event loop itself.
+    That is the default on a single CPU, where workers would only compete
+    with the event loop and add the cost of passing batches around.
+    """
+    def __init__(self, vehicle, batch_size=8192, workers=None, max_pending=None):
+        self.vehicle = vehicle
+        self.batch_size = batch_size
+        if workers == None:
+            cpus = os.cpu_count() or 1
+            workers = cpus if cpus >= 2 else 0
+        self.workers = workers
+        self.max_pending = max_pending if max_pending != None else max(1, 2 * self.workers)
+
+        self.batches = 0
+        self.samples_analyzed = 0
+        self.samples_dropped = 0
+
+        self._running = False
+        self._loop = None
+        self._pool = None
+        self._pending = set()
+        self._handler_ids = []
+        self._subscriptions = {}
+        self._last_subscription = 0
+        self._free = []
+        self._segments = []
+        self._segment = None
+        self._buf = None
+        self._n = 0
+
+        self._channel_names = channel_names(vehicle)
+        self._channel_ids = { (peripheral, cap) : base for name, peripheral, cap, base, n in channels(vehicle) }
+
+    @property
+    def channels(self):
+        return list(self._channel_names)
+
+    def subscribe(self, analysis, callback):
+        """
+        Run `analysis` over each batch and call `callback(result)` (in
+        vehicle's event loop) with its result. Return subscription id
+        to be passed to `unsubscribe()`.
+        """
+        self._last_subscription += 1
+        self._subscriptions[self._last_subscription] = (analysis, callback)
+        return self._last_subscription
+
+    def unsubscribe(self, subscription):
+        self._subscriptions.pop(subscription, None)
+
+    def start(self):
+        """
+        Start collecting samples. Must be called from within the (running)
+        vehicle event loop.
+        """
+        assert not self._running, "analytics already started"
+        self._loop = get_event_loop()
+        if self.workers > 0:
+            # Do not fork (possibly multi-threaded) application itself
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('forkserver'))
+        self._new_batch()
+        for name, peripheral in peripherals(self.vehicle):
+            self._handler_ids.append((peripheral, peripheral.connect('notify', self.on_peripheral_notify)))
+        self._running = True
+
+    async def stop(self):
+        """
+        Stop collecting samples, analyze remaining ones and wait for all
+        results to be delivered.
+        """
+        if not self._running:
+            return
+        self._running = False
+        for peripheral, handler_id in self._handler_ids:
+            peripheral.disconnect(handler_id)
+        self._handler_ids = []
+        self._flush()
+        await gather(*self._pending, return_exceptions=True)
+        if self._pool != None:
+            self._pool.shutdown()
+            self._pool = None
+        self._buf.release()
+        self._buf = None
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+        self._free = []
+
+    @property
+    def running(self):
+        return self._running
+
+    def on_peripheral_notify(self, peripheral):
+        if not self._running:
+            return
+        now = time()
+        for cap in peripheral.capabilities:
+            channel = self._channel_ids[(peripheral, cap)]
+            for value in values(peripheral, cap):
+                self.append(now, channel, value)
+                channel += 1
+
+    def append(self, t, channel, value):
+        """
+        Add a sample to current batch.
+        """
+        buf = self._buf
+        n = self._n
+        buf[n] = t
+        buf[self.batch_size + n] = channel
+        buf[2 * self.batch_size + n] = value
+        self._n = n + 1
+        if self._n >= self.batch_size:
+            self._flush()
+
+    def _new_batch(self):
+        if self._free:
+            self._segment = self._free.pop()
+        else:
+            self._segment = shared_memory.SharedMemory(create=True, size=3 * 8 * self.batch_size)
+            self._segments.append(self._segment)
+        self._buf = self._segment.buf.cast('d')
+        self._n = 0
+
+    def _flush(self):
+        """
+        Hand over current batch to workers and start a new one.
+        """
+        n = self._n
+        if n == 0:
+            return
+        if not self._subscriptions:
+            self._n = 0
+            return
+        if len(self._pending) >= self.max_pending:
+            if self.samples_dropped == 0:
+                logger.warning("analytics cannot keep up, dropping samples")
+            self.samples_dropped += n
+            self._n = 0
+            return
+        segment = self._segment
+        subscriptions = list(self._subscriptions.values())
+        analyses = [analysis for analysis, callback in subscriptions]
+        self.batches += 1
+        self.samples_analyzed += n
+        if self._pool == None:
+            results = _analyze_buffer(self._buf, self.batch_size, n, analyses, self._channel_names)
+            self._n = 0
+            for (analysis, callback), result in zip(subscriptions, results):
+                self._loop.call_soon(callback, result)
+            return
+        self._buf.release()
+        self._new_batch()
+        future = self._loop.run_in_executor(self._pool, _analyze, segment.name, self.batch_size, n, analyses, self._channel_names)
+        self._pending.add(future)
+        future.add_done_callback(lambda future: self._on_analyzed(future, segment, subscriptions))
+
+    def _on_analyzed(self, future, segment, subscriptions):
+        self._pending.discard(future)
+        self._free.append(segment)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error("analysis failed: %s", future.exception())
+            return
+        for (analysis, callback), result in zip(subscriptions, future.result()):
+            callback(result)
+
+
+def _analyze_buffer(buf, capacity, n, analyses, names):
+    with buf[0:n] as times, buf[capacity:capacity + n] as channels, buf[2 * capacity:2 * capacity + n] as values:
+        return [analysis(times, channels, values, names) for analysis in analyses]
+
+
+if __name__ == '__main__':
+    # Feed simulated telemetry as fast as possible and compare analytics
+    # throughput and event loop lag with analyses running in the loop
+    # and in worker processes.
+    import asyncio
+    from time import monotonic
+    from controlminus.simulator import SimulatedVehicle
+    from controlminus.analytics import channel_statistics
+
+    async def run(workers, seconds=3):
+        vehicle = SimulatedVehicle()
+        vehicle.set_property('speed', 60)
+        vehicle.set_property('steering', 30)
+        analytics = AnalyticsExecutor(vehicle, workers=workers)
+        results = []
+        analytics.subscribe(channel_statistics, results.append)
+        analytics.start()
+
+        lags = []
+        async def ticker():
+            # Stands for control loop running at 100 Hz
+            while True:
+                started = monotonic()
+                await asyncio.sleep(0.01)
+                lags.append(monotonic() - started - 0.01)
+
+        tick = asyncio.get_event_loop().create_task(ticker())
+        started = monotonic()
+        while monotonic() - started < seconds:
+            for i in range(20):
+                vehicle.step(0.05)
+            await asyncio.sleep(0)
+        await analytics.stop()
+        elapsed = monotonic() - started
+        tick.cancel()
+        lags.sort()
+        print("I: %d workers: %d batches analyzed, %.0f samples/s, %d dropped, loop lag p50 %.1f ms, p99 %.1f ms" % (
+            workers, len(results), analytics.samples_analyzed / elapsed, analytics.samples_dropped,
+            lags[len(lags) // 2] * 1000, lags[int(len(lags) * 0.99)] * 1000))
+
+    print("I: %d CPUs" % os.cpu_count())
+    for workers in sorted(set([0, 1, os.cpu_count()])):
+        asyncio.run(run(workers))
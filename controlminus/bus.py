@@ -0,0 +1,214 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Lightweight publish/subscribe bus for sensor samples.
+
+Subscribers register for the fields (channels or whole capabilities)
+they are interested in and get called with just their values whenever
+any of them changes:
+
+    bus = SensorBus(vehicle)
+    bus.subscribe(on_heading, 'position.sense_pos.0')
+    bus.subscribe(on_motors, 'motor_a.sense_speed', 'motor_b.sense_speed')
+
+    def on_motors(time, speed_a, speed_b):
+        ...
+
+Field names are those of `controlminus.telemetry.channel_name()`; a
+capability name like `position.sense_pos` gives capability's value as
+is (a list for multi-dataset capabilities). Dispatch tables mapping
+each peripheral to its subscribers and the values they read are
+precomputed on (un)subscription so a notification costs a single
+dictionary lookup plus the calls.
+"""
+from operator import itemgetter
+from time import monotonic
+
+from controlminus.telemetry import peripherals, channels, channel_name
+
+
+class SensorBus:
+    """
+    Sensor bus for given vehicle. If `connect` is true, bus subscribes
+    to peripherals' `notify` signal itself, otherwise `publish()` must
+    be called (for example with coalesced notifications from control
+    thread).
+    """
+    def __init__(self, vehicle, connect=True, clock=monotonic):
+        self.clock = clock
+        self.publications = 0
+        self.deliveries = 0
+        self._fields = {}
+        for name, peripheral, cap, base, n in channels(vehicle):
+            self._fields[channel_name(name, cap, 0, 1)] = (peripheral, cap, None)
+            if n > 1:
+                for index in range(n):
+                    self._fields[channel_name(name, cap, index, n)] = (peripheral, cap, index)
+        for name, peripheral in peripherals(vehicle):
+            if connect:
+                peripheral.connect('notify', self.on_peripheral_notify)
+        self._subscriptions = {}
+        self._last_subscription = 0
+        self._table = {}
+
+    def fields(self):
+        """
+        Return names of all fields one can subscribe to.
+        """
+        return list(self._fields.keys())
+
+    def subscribe(self, callback, *fields):
+        """
+        Call `callback(time, value1, value2, ...)` with values of given
+        fields whenever one of them changes. Return subscription id to be
+        passed to `unsubscribe()`. Raise `KeyError` for unknown field.
+        """
+        readers = tuple(self._fields[field] for field in fields)
+        self._last_subscription += 1
+        self._subscriptions[self._last_subscription] = (callback, readers, self._reader(readers))
+        self._rebuild()
+        return self._last_subscription
+
+    def unsubscribe(self, subscription):
+        if self._subscriptions.pop(subscription, None) != None:
+            self._rebuild()
+
+    def _reader(self, readers):
+        """
+        Return a function returning tuple of values for given readers.
+        """
+        owners = set(owner for owner, cap, index in readers)
+        # Peripheral may notify before it has any value, like in read()
+        # below, values are None then.
+        nones = (None, ) * len(readers)
+        if len(owners) == 1:
+            owner = owners.pop()
+            if all(index == None for owner, cap, index in readers):
+                # Common case: whole capabilities of single peripheral
+                if len(readers) == 1:
+                    cap = readers[0][1]
+                    return lambda: (owner.value[cap], ) if owner.value else nones
+                getter = itemgetter(*[cap for owner, cap, index in readers])
+                return lambda: getter(owner.value) if owner.value else nones
+            if len(set(cap for owner, cap, index in readers)) == 1 and all(index != None for owner, cap, index in readers):
+                # Some channels of single capability
+                cap = readers[0][1]
+                getter = itemgetter(*[index for owner, cap, index in readers])
+                if len(readers) == 1:
+                    return lambda: (getter(owner.value[cap]), ) if owner.value and owner.value[cap] != None else nones
+                return lambda: getter(owner.value[cap]) if owner.value and owner.value[cap] != None else nones
+        def read():
+            result = []
+            for owner, cap, index in readers:
+                value = owner.value[cap] if owner.value else None
+                if index != None and value != None:
+                    value = value[index]
+                result.append(value)
+            return result
+        return read
+
+    def _rebuild(self):
+        table = {}
+        for callback, readers, read in self._subscriptions.values():
+            for peripheral in dict.fromkeys(reader[0] for reader in readers):
+                table.setdefault(peripheral, []).append((callback, read))
+        self._table = { peripheral : tuple(entries) for peripheral, entries in table.items() }
+
+    def publish(self, peripheral, time=None):
+        """
+        Deliver current values to subscribers of given peripheral.
+        """
+        entries = self._table.get(peripheral)
+        if entries == None:
+            return
+        if time == None:
+            time = self.clock()
+        self.publications += 1
+        self.deliveries += len(entries)
+        for callback, read in entries:
+            callback(time, *read())
+
+    def on_peripheral_notify(self, peripheral):
+        self.publish(peripheral)
+
+
+if __name__ == '__main__':
+    # Compare per-notification cost of VehicleApp's original handler
+    # (loop over all capabilities, dictionary lookups, comparison with
+    # vehicle.position) with the bus doing the same work.
+    from controlminus.simulator import SimulatedVehicle
+
+    vehicle = SimulatedVehicle()
+    vehicle.step(0.05)
+    rows = {}
+    store = [None] * 64
+    for name, peripheral in vehicle.peripherals.items():
+        for cap in peripheral.capabilities:
+            rows[(peripheral, cap)] = len(rows)
+    angles = [0, 0, 0]
+
+    def original(peripheral):
+        for cap in peripheral.capabilities:
+            store[rows[(peripheral, cap)]] = str(peripheral.value[cap])
+        if peripheral == vehicle.position:
+            angles[0] = peripheral.sense_pos[0]
+            angles[1] = peripheral.sense_pos[1]
+            angles[2] = peripheral.sense_pos[2]
+
+    bus = SensorBus(vehicle, connect=False)
+    for name, peripheral in vehicle.peripherals.items():
+        def rows_updater(peripheral):
+            indices = [rows[(peripheral, cap)] for cap in peripheral.capabilities]
+            def update(time, *values):
+                for index, value in zip(indices, values):
+                    store[index] = str(value)
+            return update
+        bus.subscribe(rows_updater(peripheral), *["%s.%s" % (name, cap.name) for cap in peripheral.capabilities])
+
+    def on_angles(time, yaw, pitch, roll):
+        angles[0] = yaw
+        angles[1] = pitch
+        angles[2] = roll
+    bus.subscribe(on_angles, 'position.sense_pos.0', 'position.sense_pos.1', 'position.sense_pos.2')
+
+    notifications = list(vehicle.peripherals.values()) * 20000
+    def measure(name, handler):
+        started = monotonic()
+        for peripheral in notifications:
+            handler(peripheral)
+        elapsed = monotonic() - started
+        print("I: %-30s %.2f us per notification" % (name, elapsed / len(notifications) * 1e6))
+
+    measure("dashboard, original", original)
+    measure("dashboard, bus", bus.publish)
+
+    # Bearing indicator only, as when telemetry page is not shown
+    def original_bearing(peripheral):
+        for cap in peripheral.capabilities:
+            rows[(peripheral, cap)]
+        if peripheral == vehicle.position:
+            angles[0] = peripheral.sense_pos[0]
+            angles[1] = peripheral.sense_pos[1]
+            angles[2] = peripheral.sense_pos[2]
+    bus = SensorBus(vehicle, connect=False)
+    bus.subscribe(on_angles, 'position.sense_pos.0', 'position.sense_pos.1', 'position.sense_pos.2')
+    measure("bearing only, original", original_bearing)
+    measure("bearing only, bus", bus.publish)
@@ -0,0 +1,153 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Support for running vehicle control in a dedicated thread, separated
+from the UI (GTK) main loop.
+
+`ControlThread` runs an asyncio event loop in its own thread. `StateChannel`
+passes state updates between threads, coalescing them so a slow consumer
+sees only the latest value for each key rather than a growing backlog.
+"""
+from asyncio import SelectorEventLoop, set_event_loop, run_coroutine_threadsafe
+from concurrent.futures import Future
+from threading import Thread, Lock, get_ident
+
+
+class ControlThread(Thread):
+    """
+    A (daemon) thread running an asyncio event loop. Usage:
+
+        control = ControlThread()
+        control.start()
+        control.call(some_function, arg)
+        future = control.submit(some_coroutine())
+        ...
+        control.stop()
+    """
+    def __init__(self, name='control'):
+        super().__init__(name=name, daemon=True)
+        # Do not use event loop policy here, application may have set
+        # one that supports only the main thread.
+        self.loop = SelectorEventLoop()
+
+    def run(self):
+        set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if get_ident() != self.ident:
+            self.join()
+
+    def call(self, func, *args):
+        """
+        Call `func` in control thread (asynchronously).
+        """
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def call_sync(self, func, *args):
+        """
+        Call `func` in control thread, wait for it to complete and
+        return its result.
+        """
+        if get_ident() == self.ident:
+            return func(*args)
+        future = Future()
+        def call():
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        self.loop.call_soon_threadsafe(call)
+        return future.result()
+
+    def submit(self, coro):
+        """
+        Schedule coroutine in control thread, return a
+        `concurrent.futures.Future`.
+        """
+        return run_coroutine_threadsafe(coro, self.loop)
+
+
+class StateChannel:
+    """
+    Passes state updates from one thread to a consumer in another. Updates
+    are coalesced: `consumer` is called (using `schedule`) with a dict
+    of updates and when the consumer is slower than the producer, it gets
+    only the latest value for each key.
+
+    `schedule` is a function scheduling a call in consumer's thread, like
+    `loop.call_soon_threadsafe` or `GLib.idle_add`.
+    """
+    def __init__(self, schedule, consumer):
+        self._schedule = schedule
+        self._consumer = consumer
+        self._lock = Lock()
+        self._pending = {}
+        self._scheduled = False
+        self.updates = 0
+        self.deliveries = 0
+
+    def put(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            self.updates += 1
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._schedule(self._deliver)
+
+    def _deliver(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._scheduled = False
+        self.deliveries += 1
+        self._consumer(pending)
+        # Do not repeat when scheduled by GLib.idle_add()
+        return False
+
+
+if __name__ == '__main__':
+    # Demonstrate that a slow consumer does not delay producer nor builds
+    # up a backlog.
+    from time import sleep, monotonic
+
+    control = ControlThread()
+    control.start()
+    received = []
+
+    def consume(updates):
+        received.append(updates)
+        sleep(0.01)
+
+    channel = StateChannel(control.call, consume)
+    started = monotonic()
+    for i in range(100000):
+        channel.put('speed', i % 100)
+        channel.put('steering', -i % 100)
+    elapsed = monotonic() - started
+    sleep(0.1)
+    control.stop()
+    print("I: %d updates in %.3fs, %d deliveries, last %s" % (channel.updates, elapsed, channel.deliveries, received[-1]))
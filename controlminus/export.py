@@ -0,0 +1,271 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Streaming export of vehicle's telemetry to columnar files.
+
+Telemetry is written in "long" format, one row per value:
+
+  * `time` - time of the notification (seconds since epoch, float64)
+  * `channel` - name of the channel, like `motor_a.sense_speed` or
+    `position.sense_pos.0` (dictionary-encoded string). Commanded
+    speed and steering are recorded as `vehicle.speed` and
+    `vehicle.steering`.
+  * `value` - the value (float64)
+
+Rows are buffered in fixed-size row groups which are, once full, handed
+over to a writer thread. At most `max_pending` row groups may wait for
+writer, if writer cannot keep up, row groups are dropped (and counted)
+rather than buffered, so memory use does not depend on length of the
+session.
+
+Requires `pyarrow`.
+"""
+import logging
+
+from array import array
+from asyncio import get_event_loop, gather
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from controlminus.telemetry import peripherals, channels, channel_names, values
+
+logger = logging.getLogger(__name__)
+
+PARQUET_SUFFIXES = ('.parquet', '.pq')
+IPC_SUFFIXES = ('.arrow', '.arrows', '.ipc', '.feather')
+
+class TelemetryExporter:
+    """
+    Streams telemetry of given vehicle to a Parquet (`.parquet`) or Arrow IPC
+    (`.arrow`) file. Format is determined by file suffix.
+
+    Usage:
+
+        exporter = TelemetryExporter(vehicle, "session.parquet")
+        exporter.start()
+        ...
+        await exporter.stop()
+
+    An exporter may be started only once.
+    """
+    def __init__(self, vehicle, path, row_group_size=8192, max_pending=4):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Telemetry export requires pyarrow (pip install pyarrow)") from e
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+
+        if str(path).endswith(PARQUET_SUFFIXES):
+            self.format = 'parquet'
+        elif str(path).endswith(IPC_SUFFIXES):
+            self.format = 'ipc'
+        else:
+            raise ValueError("Unsupported export file type: %s" % path)
+
+        self.vehicle = vehicle
+        self.path = str(path)
+        self.row_group_size = row_group_size
+        self.max_pending = max_pending
+
+        self.rows_written = 0
+        self.rows_dropped = 0
+
+        self._recording = False
+        self._stopped = False
+        self._loop = None
+        self._executor = None
+        self._writer = None
+        self._pending = set()
+        self._handler_ids = []
+
+        # Assign numeric id to each channel. Values of a capability
+        # have consecutive ids so we only need to remember the first one.
+        self._channel_names = channel_names(vehicle)
+        self._channel_ids = { (peripheral, cap) : base for name, peripheral, cap, base, n in channels(vehicle) }
+        self._speed_channel = len(self._channel_names)
+        self._channel_names.append('vehicle.speed')
+        self._steering_channel = len(self._channel_names)
+        self._channel_names.append('vehicle.steering')
+
+        self._schema = self._pa.schema([
+            ('time', self._pa.float64()),
+            ('channel', self._pa.dictionary(self._pa.int32(), self._pa.string())),
+            ('value', self._pa.float64())
+        ])
+        self._dictionary = self._pa.array(self._channel_names, self._pa.string())
+
+        self._new_row_group()
+
+    def start(self):
+        """
+        Start recording telemetry. Must be called from within the
+        (running) vehicle event loop.
+        """
+        assert not self._recording and not self._stopped, "exporter already started"
+        self._loop = get_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='telemetry-export')
+        for name, peripheral in peripherals(self.vehicle):
+            self._handler_ids.append((peripheral, peripheral.connect('notify', self.on_peripheral_notify)))
+        self._handler_ids.append((self.vehicle, self.vehicle.connect('notify::speed', self.on_vehicle_notify)))
+        self._handler_ids.append((self.vehicle, self.vehicle.connect('notify::steering', self.on_vehicle_notify)))
+        self._recording = True
+
+    async def stop(self):
+        """
+        Stop recording, write remaining rows and close the file.
+        """
+        if not self._recording:
+            return
+        self._recording = False
+        self._stopped = True
+        for source, handler_id in self._handler_ids:
+            source.disconnect(handler_id)
+        self._handler_ids = []
+        self._flush()
+        await gather(*self._pending, return_exceptions=True)
+        await self._loop.run_in_executor(self._executor, self._close)
+        self._executor.shutdown()
+
+    @property
+    def recording(self):
+        return self._recording
+
+    def on_peripheral_notify(self, peripheral):
+        if not self._recording:
+            return
+        now = time()
+        for cap in peripheral.capabilities:
+            channel = self._channel_ids[(peripheral, cap)]
+            for value in values(peripheral, cap):
+                self._append(now, channel, value)
+                channel += 1
+
+    def on_vehicle_notify(self, vehicle, prop):
+        if not self._recording:
+            return
+        if prop.name == 'speed':
+            self._append(time(), self._speed_channel, float(vehicle.get_property('speed')))
+        elif prop.name == 'steering':
+            self._append(time(), self._steering_channel, float(vehicle.get_property('steering')))
+
+    def _new_row_group(self):
+        self._times = array('d')
+        self._channels = array('i')
+        self._values = array('d')
+
+    def _append(self, t, channel, value):
+        self._times.append(t)
+        self._channels.append(channel)
+        self._values.append(value)
+        if len(self._times) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        """
+        Hand over current row group to the writer thread and start
+        a new one.
+        """
+        n = len(self._times)
+        if n == 0:
+            return
+        row_group = (self._times, self._channels, self._values)
+        self._new_row_group()
+        if len(self._pending) >= self.max_pending:
+            if self.rows_dropped == 0:
+                logger.warning("telemetry writer cannot keep up, dropping rows")
+            self.rows_dropped += n
+            return
+        future = self._loop.run_in_executor(self._executor, self._write, row_group)
+        self._pending.add(future)
+        future.add_done_callback(self._on_written)
+
+    def _on_written(self, future):
+        self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("failed to write telemetry: %s", future.exception())
+
+    # Following methods run in writer thread
+
+    def _write(self, row_group):
+        pa = self._pa
+        times, channels, values = row_group
+        n = len(times)
+        # Wrap arrays' buffers directly, no need to copy.
+        batch = pa.RecordBatch.from_arrays([
+            pa.Array.from_buffers(pa.float64(), n, [None, pa.py_buffer(times)]),
+            pa.DictionaryArray.from_arrays(pa.Array.from_buffers(pa.int32(), n, [None, pa.py_buffer(channels)]), self._dictionary),
+            pa.Array.from_buffers(pa.float64(), n, [None, pa.py_buffer(values)]),
+        ], schema=self._schema)
+        if self._writer is None:
+            if self.format == 'parquet':
+                self._writer = self._pq.ParquetWriter(self.path, self._schema, compression='zstd')
+            else:
+                self._writer = pa.ipc.new_file(self.path, self._schema)
+        if self.format == 'parquet':
+            self._writer.write_table(pa.Table.from_batches([batch]), row_group_size=n)
+        else:
+            self._writer.write_batch(batch)
+        self.rows_written += n
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+if __name__ == '__main__':
+    # Simple benchmark - stream notifications of simulated vehicle as fast
+    # as possible and report throughput and peak memory. Output goes to
+    # a temporary file unless a path is given.
+    import os
+    import sys
+    import asyncio
+    import resource
+    import tempfile
+    from controlminus.simulator import SimulatedVehicle
+
+    def handlers(vehicle):
+        return len(vehicle._handlers) + sum(len(peripheral._handlers) for peripheral in vehicle.peripherals.values())
+
+    async def benchmark(path, steps):
+        vehicle = SimulatedVehicle()
+        vehicle.set_property('speed', 50)
+        vehicle.set_property('steering', 30)
+        exporter = TelemetryExporter(vehicle, path)
+        connected = handlers(vehicle)
+        exporter.start()
+        started = time()
+        for i in range(steps):
+            vehicle.step(0.05)
+            if i % 100 == 0:
+                await asyncio.sleep(0)
+        await exporter.stop()
+        elapsed = time() - started
+        assert handlers(vehicle) == connected, "handlers left connected"
+        print("I: %d rows written, %d dropped in %.2fs (%.0f rows/s), max RSS %d kB" % (exporter.rows_written, exporter.rows_dropped, elapsed, exporter.rows_written / elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+    if len(sys.argv) > 1:
+        asyncio.get_event_loop().run_until_complete(benchmark(sys.argv[1], 200000))
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.get_event_loop().run_until_complete(benchmark(os.path.join(directory, 'telemetry-benchmark.parquet'), 200000))
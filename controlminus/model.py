@@ -21,12 +21,18 @@
 import sys
 import logging
 
-from asyncio import sleep, CancelledError, create_task as spawn
+from asyncio import sleep, CancelledError
 from bricknil import attach, start
 from bricknil.hub import CPlusHub
 from bricknil.sensor.motor import CPlusXLMotor, CPlusLargeMotor as CPlusLMotor
 from bricknil.sensor.sensor import PoweredUpHubIMUPosition, PoweredUpHubIMUAccelerometer, PoweredUpHubIMUGyro, VoltageSensor, CurrentSensor
 
+from controlminus.actuator import Actuators
+from controlminus.snapshot import SensorStore
+from controlminus.odometry import Odometry
+from controlminus.prediction import Predictor
+from controlminus.supervisor import Supervisor
+
 
 @attach(CPlusXLMotor, name='motor_a', port=0, capabilities=[('sense_speed', 5), ('sense_load', 5), ('sense_power', 5)])
 @attach(CPlusXLMotor, name='motor_b', port=1, capabilities=[('sense_speed', 5), ('sense_load', 5), ('sense_power', 5)])
@@ -40,9 +46,26 @@ class Vehicle(CPlusHub):
     SteerIncrement = 10
     SpeedIncrement = 30
 
+    # Drive profiles, (name, maximum speed in percent)
+    Profiles = [
+        ('normal', 100),
+        ('eco', 60),
+        ('crawl', 30)
+    ]
+
+    # Figures for dead-reckoning (see `controlminus.odometry`): vehicle
+    # speed in mm/s at 100% motor speed and heading change in degrees
+    # per second at full speed and full lock. These are rough guesses
+    # (same as simulator uses), NOT calibrated on a real vehicle - measure
+    # distance driven and heading change over some time at full speed
+    # (and full lock) and adjust before relying on odometry without gyro.
+    TopSpeed = 1000
+    TurnRate = 60
+
     _properties_ = [
         'steering',
-        'speed'
+        'speed',
+        'profile'
     ]
 
     def __init__(self, name="4x4 off-roader", query_port_info=False, ble_id=None):
@@ -53,7 +76,21 @@ class Vehicle(CPlusHub):
         self.steering_angle_max = 0
         self.steering_calibration_in_process = False
 
+        # All motor commands except calibration go through actuator
+        # cache to avoid redundant BLE writes.
+        self.actuators = Actuators()
+
+        # Property changes start tasks, at most one of each kind runs
+        # at a time, only the latest pending one is kept.
+        self.supervisor = Supervisor(max_live=50)
+        for name in ('speed', 'steering', 'profile', 'calibrate'):
+            self.supervisor.limit(name, 1)
+
         self.__speed = 0
+        self.__profile = 0
+        self.__sensors = None
+        self.__odometry = None
+        self.__predictor = None
 
     async def get_speed(self):
         return self.__speed
@@ -65,13 +102,26 @@ class Vehicle(CPlusHub):
         -100 is full speed reversing.
         """
         if abs(pct) < 10:
-            await self.motor_a.set_speed(0)
-            await self.motor_b.set_speed(0)
+            await self.actuators.set_speed(self.motor_a, 0)
+            await self.actuators.set_speed(self.motor_b, 0)
         else:
-            await self.motor_a.set_speed(-1*pct)
-            await self.motor_b.set_speed(-1*pct)
+            limit = self.Profiles[self.__profile][1]
+            await self.actuators.set_speed(self.motor_a, -1*int(pct * limit / 100))
+            await self.actuators.set_speed(self.motor_b, -1*int(pct * limit / 100))
         self.__speed = pct
 
+    async def get_profile(self):
+        return self.__profile
+
+    async def set_profile(self, profile):
+        """
+        Set drive profile, an index into `Profiles`.
+        """
+        if not (0 <= profile < len(self.Profiles)):
+            raise ValueError('invalid profile %s' % profile)
+        self.__profile = profile
+        await self.set_speed(self.__speed)
+
     async def get_steering(self):
         return self.steering_target
 
@@ -94,21 +144,25 @@ class Vehicle(CPlusHub):
         #self.message_info("steering_target = %d, speed = %d" % (self.steering_target, speed))
         print("I:steering_target = %d, speed = %d" % (self.steering_target, speed))
 
-        await self.steering.set_pos(self.steering_target, speed=speed, max_power=100)
+        await self.actuators.set_pos(self.steering, self.steering_target, speed=speed, max_power=100)
 
     def do_get_property(self, prop):
         if prop.name == 'speed':
             return self.__speed
         elif prop.name == 'steering':
             return self.steering_target
+        elif prop.name == 'profile':
+            return self.__profile
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
     def do_set_property(self, prop, value):
         if prop.name == 'speed':
-            spawn(self.set_speed(value))
+            self.supervisor.spawn(self.set_speed(value), 'speed')
         elif prop.name == 'steering':
-            spawn(self.set_steering(value))
+            self.supervisor.spawn(self.set_steering(value), 'steering')
+        elif prop.name == 'profile':
+            self.supervisor.spawn(self.set_profile(value), 'profile')
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
@@ -125,16 +179,25 @@ class Vehicle(CPlusHub):
         #         await self.steering.set_speed(0)
 
     async def steering_calibrate(self):
-        async def wait_until_steering_stop():
-            angle1 = 100000
-            angle2 = self.steering_angle
-            while angle1 != angle2:
-                angle1 = angle2
-                await sleep(1)
-                angle2 = self.steering_angle
+        async def wait_until_steering_stop(settle=0.3, poll=0.05):
+            # Steering stopped once its position has not changed for
+            # `settle` seconds. Polling often instead of sleeping for
+            # fixed time keeps calibration (and thus time until vehicle
+            # can be driven) short.
+            angle = self.steering_angle
+            still = 0
+            while still < settle:
+                await sleep(poll)
+                if self.steering_angle == angle:
+                    still += poll
+                else:
+                    angle = self.steering_angle
+                    still = 0
+        # Calibration moves steering directly (and resets its position)
+        self.steering_calibration_in_process = True
+        self.actuators.invalidate(self.steering)
         await self.steering.reset_pos();
 
-        self.steering_calibration_in_process = True
         # await self.steering.set_speed(60)
         await self.steering.rotate(180, 50, 100)
         await wait_until_steering_stop()
@@ -160,7 +223,7 @@ class Vehicle(CPlusHub):
         self.message_info(": steering_calibrate 1: %s (zero) %s (min) %s (max)" % (zero, self.steering_angle_min, self.steering_angle_max))
 
         await self.steering.set_pos(zero, speed=50)
-        await sleep(2)
+        await wait_until_steering_stop()
 
         await self.steering.reset_pos()
         zero = 0
@@ -169,7 +232,8 @@ class Vehicle(CPlusHub):
         self.steering_target = 0
         self.message_info(": steering_calibrate 2: %s (zero) %s (min) %s (max)" % (zero, self.steering_angle_min, self.steering_angle_max))
 
-        await sleep(2)
+        await wait_until_steering_stop()
+        self.actuators.invalidate(self.steering)
         self.steering_calibration_in_process = False
 
     async def steer(self, pct, speed=60):
@@ -185,7 +249,70 @@ class Vehicle(CPlusHub):
         await self.set_speed(0)
 
 
+    @property
+    def sensors(self):
+        """
+        Sensor store keeping latest values of all peripherals.
+        """
+        return self._ensure_sensors()
+
+    def _ensure_sensors(self):
+        """
+        Create sensor store unless already created and return it. It cannot
+        be created in `__init__` since peripherals are attached only after
+        vehicle is instantiated.
+        """
+        if self.__sensors == None:
+            self.__sensors = SensorStore(self)
+        return self.__sensors
+
+    @property
+    def odometry(self):
+        """
+        Dead-reckoning pose estimate, see `controlminus.odometry`.
+        """
+        return self._ensure_odometry()
+
+    def _ensure_odometry(self):
+        """
+        Create odometry unless already created and return it, see
+        `_ensure_sensors()`.
+        """
+        if self.__odometry == None:
+            self.__odometry = Odometry(self)
+        return self.__odometry
+
+    @property
+    def predictor(self):
+        """
+        Latency-compensated sensor values, see `controlminus.prediction`.
+        Created lazily on first use (it has to be after peripherals are
+        attached), so it costs nothing unless somebody needs it.
+        """
+        if self.__predictor == None:
+            self.__predictor = Predictor(self)
+        return self.__predictor
+
+    def snapshot(self):
+        """
+        Return consistent snapshot of all sensor values, see
+        `controlminus.snapshot`.
+        """
+        return self.sensors.snapshot()
+
+    async def next_snapshot(self, version=None):
+        """
+        Wait for and return snapshot newer than `version`.
+        """
+        return await self.sensors.next(version)
+
     async def initialize(self):
+        # Hub has just (re)connected, its state is unknown
+        self.actuators.invalidate()
+        self._ensure_sensors()
+        self._ensure_odometry()
+        # Vehicle must not be driven before steering is calibrated,
+        # so `initialized` (and thus drivable) only after calibration.
         await self.steering_calibrate()
 
     async def finalize(self):
@@ -0,0 +1,202 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Dead-reckoning odometry.
+
+`Odometry` integrates drive motors' speed, steering angle and IMU
+heading into 2D pose estimate on every sensor notification. Positions
+are in millimeters, heading in degrees (counter-clockwise, 0 being the
+initial direction). Usage:
+
+    odometry = Odometry(vehicle)
+    ...
+    print(odometry.pose)
+    for pose in odometry.trajectory(10):
+        ...
+"""
+from collections import deque, namedtuple
+from math import sin, cos, radians
+from time import monotonic
+
+Pose = namedtuple('Pose', ['time', 'x', 'y', 'heading'])
+
+
+def _capability(peripheral, name):
+    for cap in peripheral.capabilities:
+        if cap.name == name:
+            return cap
+    return None
+
+
+def _wrap(angle):
+    return (angle + 180) % 360 - 180
+
+
+class Odometry:
+    """
+    Estimate pose of given vehicle.
+
+    Distance travelled is computed from average of `motor_a` and
+    `motor_b` speed, `top_speed` being the vehicle speed (in mm/s) at
+    100% motor speed. Heading rate comes from `gyro` (its `gyro_axis`
+    value, in degrees per second) if vehicle has one, otherwise from
+    steering angle, `turn_rate` being the heading change (in degrees
+    per second) at full speed and full lock. Unless given, `top_speed`
+    and `turn_rate` are taken from vehicle's `TopSpeed` and `TurnRate`
+    (see `controlminus.model.Vehicle`). Heading is then slowly
+    pulled towards absolute yaw from `position` by factor `alpha` to
+    correct drift.
+
+    Recent poses are kept in trajectory, at most one every `resolution`
+    seconds and at most `capacity` of them.
+    """
+    def __init__(self, vehicle, top_speed=None, turn_rate=None, gyro_axis=2, alpha=0.05,
+                 resolution=0.05, capacity=4096, clock=monotonic):
+        self.vehicle = vehicle
+        self.top_speed = top_speed if top_speed != None else vehicle.TopSpeed
+        self.turn_rate = turn_rate if turn_rate != None else vehicle.TurnRate
+        self.gyro_axis = gyro_axis
+        self.alpha = alpha
+        self.resolution = resolution
+        self.clock = clock
+        self.distance = 0.0
+        self._trajectory = deque(maxlen=capacity)
+        self._motors = []
+        for name in ('motor_a', 'motor_b'):
+            motor = vehicle.peripherals.get(name)
+            if motor != None and _capability(motor, 'sense_speed') != None:
+                self._motors.append((motor, _capability(motor, 'sense_speed')))
+        self._steering = vehicle.peripherals.get('steering')
+        self._gyro = vehicle.peripherals.get('gyro')
+        self._position = vehicle.peripherals.get('position')
+        self._speed = 0.0
+        self._rate = 0.0
+        self.reset()
+        for peripheral in [motor for motor, cap in self._motors] + [self._steering, self._gyro, self._position]:
+            if peripheral != None:
+                peripheral.connect('notify', self.on_peripheral_notify)
+
+    def reset(self, x=0.0, y=0.0, heading=0.0):
+        """
+        Reset pose (and clear trajectory).
+        """
+        self.x = x
+        self.y = y
+        self.heading = heading
+        self.time = self.clock()
+        self._trajectory.clear()
+        self._trajectory.append(self.pose)
+        self._yaw_offset = None
+
+    @property
+    def pose(self):
+        """
+        Current pose estimate as `Pose`.
+        """
+        return Pose(self.time, self.x, self.y, self.heading)
+
+    @property
+    def speed(self):
+        """
+        Current vehicle speed in mm/s.
+        """
+        return self._speed
+
+    def trajectory(self, seconds=None):
+        """
+        Return list of recent poses, oldest first. If `seconds` is
+        given, only poses from last `seconds` are returned.
+        """
+        if seconds == None:
+            return list(self._trajectory)
+        since = self.time - seconds
+        return [pose for pose in self._trajectory if pose.time >= since]
+
+    def _steering_lock(self):
+        # Steering position relative to calibrated range, -1 .. 1
+        vehicle = self.vehicle
+        half = (vehicle.steering_angle_max - vehicle.steering_angle_min) / 2
+        if half <= 0:
+            return 0.0
+        center = (vehicle.steering_angle_max + vehicle.steering_angle_min) / 2
+        return max(-1.0, min(1.0, (self._steering.sense_pos - center) / half))
+
+    def on_peripheral_notify(self, peripheral):
+        # Integrate over time since last notification using values held
+        # since then, then pick up new values.
+        now = self.clock()
+        dt = now - self.time
+        if dt > 0:
+            heading = self.heading + self._rate * dt / 2
+            distance = self._speed * dt
+            self.x += distance * cos(radians(heading))
+            self.y += distance * sin(radians(heading))
+            self.heading = _wrap(self.heading + self._rate * dt)
+            self.distance += abs(distance)
+            self.time = now
+            if now - self._trajectory[-1].time >= self.resolution:
+                self._trajectory.append(self.pose)
+
+        if peripheral == self._position:
+            yaw = self._position.sense_pos
+            yaw = yaw[0] if isinstance(yaw, (list, tuple)) else yaw
+            if yaw != None:
+                if self._yaw_offset == None:
+                    self._yaw_offset = _wrap(self.heading - yaw)
+                self.heading = _wrap(self.heading + self.alpha * _wrap(yaw + self._yaw_offset - self.heading))
+            return
+
+        speeds = [motor.value[cap] for motor, cap in self._motors if motor.value[cap] != None]
+        if speeds:
+            # Motors are mounted reversed, see Vehicle.set_speed()
+            self._speed = -sum(speeds) / len(speeds) / 100 * self.top_speed
+        if self._gyro != None:
+            rate = self._gyro.sense_rot
+            if rate != None:
+                self._rate = float(rate[self.gyro_axis])
+        elif self._steering != None and self._steering.sense_pos != None:
+            self._rate = self.turn_rate * self._steering_lock() * self._speed / self.top_speed
+
+
+if __name__ == '__main__':
+    # Drive simulated vehicle and compare estimated pose with ground truth
+    from controlminus.simulator import SimulatedVehicle
+
+    for gyro in (True, False):
+        vehicle = SimulatedVehicle()
+        if not gyro:
+            del vehicle.peripherals['gyro']
+            del vehicle.peripherals['position']
+        odometry = Odometry(vehicle, clock=lambda: vehicle.time)
+        steps = 0
+        started = monotonic()
+        for speed, steering, seconds in ((50, 0, 5), (80, 40, 10), (60, -100, 5), (100, 0, 3), (-40, 60, 5)):
+            vehicle.set_property('speed', speed)
+            vehicle.set_property('steering', steering)
+            for i in range(seconds * 20):
+                vehicle.step(0.05)
+                steps += 1
+        elapsed = monotonic() - started
+        error = ((odometry.x - vehicle.x) ** 2 + (odometry.y - vehicle.y) ** 2) ** 0.5
+        print("I: %s: after %.0f mm, position error %.0f mm (%.1f%%), heading error %.1f deg, %d poses in trajectory, %.1f us per step" % (
+            "gyro + position" if gyro else "steering only",
+            odometry.distance, error, error / odometry.distance * 100, abs(_wrap(odometry.heading - vehicle.heading)),
+            len(odometry.trajectory()), elapsed / steps * 1e6))
@@ -0,0 +1,259 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Latency-compensated sensor values.
+
+Sensor notifications arrive some time after the hub sampled the values,
+so a value read "now" actually describes the vehicle as it was a while
+ago. `Predictor` timestamps each sample with its arrival time minus
+estimated link delay and extrapolates recent history of each channel
+to the current time. Usage:
+
+    predictor = Predictor(vehicle)
+    ...
+    yaw = predictor.predict('position.sense_pos.0')
+
+Link delay is estimated as half of the fastest motor command round trip
+(BLE write with response) seen so far, like NTP estimates one-way delay,
+falling back to `default_delay`.
+
+Hubs only notify when a value changes, so a channel that has not been
+updated for a while is assumed to hold still: extrapolation never goes
+further than `max_horizon` past the last sample.
+"""
+from math import nan
+from time import monotonic
+
+from controlminus.telemetry import peripherals, channels, channel_names, values
+
+# Channels holding angles in degrees wrapping at +-180
+ANGULAR = ('position.sense_pos.0', 'position.sense_pos.1', 'position.sense_pos.2')
+
+
+class _History:
+    """
+    Fixed-size ring of (time, value) samples of one channel. Angular
+    values are unwrapped so they can be extrapolated across +-180.
+    """
+    threshold = 0.9
+
+    def __init__(self, size, angular):
+        self.size = size
+        self.angular = angular
+        self.times = [nan] * size
+        self.values = [nan] * size
+        self.count = 0
+
+    def add(self, time, value):
+        if self.angular and self.count > 0 and value == value:
+            last = self.values[(self.count - 1) % self.size]
+            if last == last:
+                value = last + (value - last + 180) % 360 - 180
+        index = self.count % self.size
+        self.times[index] = time
+        self.values[index] = value
+        self.count += 1
+
+    def predict(self, time, max_horizon):
+        """
+        Fit a line through samples (least squares) and evaluate it at
+        given time.
+        """
+        n = min(self.count, self.size)
+        if n == 0:
+            return nan
+        last = (self.count - 1) % self.size
+        t0 = self.times[last]
+        v0 = self.values[last]
+        if n == 1 or v0 != v0:
+            return v0
+        mean_t = mean_v = 0.0
+        for i in range(n):
+            mean_t += self.times[i] - t0
+            mean_v += self.values[i]
+        mean_t /= n
+        mean_v /= n
+        stt = stv = svv = 0.0
+        for i in range(n):
+            dt = self.times[i] - t0 - mean_t
+            dv = self.values[i] - mean_v
+            stt += dt * dt
+            stv += dt * dv
+            svv += dv * dv
+        if stt <= 0 or svv <= 0 or stv != stv:
+            return v0
+        # Scale the slope by how well the line fits (coefficient of
+        # determination) so steps (such as a new speed command) are not
+        # extrapolated as if they were ramps.
+        fit = stv * stv / (stt * svv)
+        if fit < self.threshold:
+            return v0
+        horizon = min(time - t0, max_horizon)
+        value = v0 + fit * stv / stt * horizon
+        if self.angular:
+            value = (value + 180) % 360 - 180
+        return value
+
+
+class Predictor:
+    """
+    Keeps last `history` samples of each channel of given vehicle (if
+    any, channels can also be fed with `add()`) and predicts their
+    current values. If `connect` is False, samples are not taken from
+    vehicle's notifications, caller feeds them with `add()` and vehicle
+    is used only to estimate link delay.
+    """
+    default_delay = 0.03
+
+    def __init__(self, vehicle=None, history=6, max_horizon=0.2, angular=ANGULAR, clock=monotonic, connect=True):
+        self.vehicle = vehicle
+        self.history = history
+        self.max_horizon = max_horizon
+        self.angular = set(angular)
+        self.clock = clock
+        self._channels = {}
+        self._histories = {}
+        if vehicle != None and connect:
+            names = channel_names(vehicle)
+            for name, peripheral, cap, base, n in channels(vehicle):
+                self._histories[(peripheral, cap)] = [ self._history(names[base + index]) for index in range(n) ]
+            for name, peripheral in peripherals(vehicle):
+                peripheral.connect('notify', self.on_peripheral_notify)
+
+    def _history(self, name):
+        history = self._channels.get(name)
+        if history == None:
+            history = self._channels[name] = _History(self.history, name in self.angular)
+        return history
+
+    @property
+    def delay(self):
+        """
+        Estimated link delay in seconds.
+        """
+        actuators = getattr(self.vehicle, 'actuators', None)
+        if actuators != None and actuators.latency.count > 0:
+            return actuators.latency.min / 2
+        return self.default_delay
+
+    def channels(self):
+        return list(self._channels.keys())
+
+    def add(self, name, value, time=None):
+        """
+        Add a sample of given channel which arrived at `time` (now if not
+        given).
+        """
+        time = self.clock() if time == None else time
+        self._history(name).add(time - self.delay, value)
+
+    def on_peripheral_notify(self, peripheral):
+        time = self.clock() - self.delay
+        for cap in peripheral.capabilities:
+            for history, value in zip(self._histories[(peripheral, cap)], values(peripheral, cap)):
+                history.add(time, value)
+
+    def predict(self, name, time=None):
+        """
+        Return predicted value of given channel at `time` (now if not
+        given), NaN if there's no sample yet.
+        """
+        history = self._channels.get(name)
+        if history == None:
+            return nan
+        return history.predict(self.clock() if time == None else time, self.max_horizon)
+
+
+def evaluate(series, delay, history=6, max_horizon=0.2, angular=ANGULAR):
+    """
+    Measure prediction error on recorded (or simulated) session. `series`
+    maps channel names to lists of (time, value) samples as the hub took
+    them. Each sample is assumed to arrive `delay` seconds later; at that
+    moment, predicted value is compared with the actual value at that
+    time (the latest sample at or before it). Return dictionary mapping
+    channel names to (samples, RMS error of using last received value,
+    RMS error of prediction).
+    """
+    result = {}
+    for name, samples in series.items():
+        predictor = Predictor(history=history, max_horizon=max_horizon, angular=angular)
+        predictor.default_delay = delay
+        truth = 0
+        n = 0
+        naive = 0.0
+        predicted = 0.0
+        for time, value in samples:
+            arrival = time + delay
+            predictor.add(name, value, arrival)
+            while truth + 1 < len(samples) and samples[truth + 1][0] <= arrival:
+                truth += 1
+            actual = samples[truth][1]
+            guess = predictor.predict(name, arrival)
+            if actual != actual or guess != guess:
+                continue
+            naive_error = value - actual
+            error = guess - actual
+            if name in angular:
+                naive_error = (naive_error + 180) % 360 - 180
+                error = (error + 180) % 360 - 180
+            naive += naive_error ** 2
+            predicted += error ** 2
+            n += 1
+        if n > 0:
+            result[name] = (n, (naive / n) ** 0.5, (predicted / n) ** 0.5)
+    return result
+
+
+if __name__ == '__main__':
+    # Evaluate prediction on a simulated session or on telemetry recorded
+    # by `controlminus.export` (pass file as argument).
+    import sys
+    from controlminus.simulator import SimulatedVehicle
+
+    if len(sys.argv) > 1:
+        import pyarrow.parquet
+        import pyarrow.ipc
+        path = sys.argv[1]
+        if path.endswith('.parquet'):
+            table = pyarrow.parquet.read_table(path)
+        else:
+            table = pyarrow.ipc.open_file(path).read_all()
+        series = {}
+        for time, channel, value in zip(table['time'].to_pylist(), table['channel'].to_pylist(), table['value'].to_pylist()):
+            series.setdefault(channel, []).append((time, value))
+    else:
+        vehicle = SimulatedVehicle()
+        series = {}
+        names = channel_names(vehicle)
+        names = [ (peripheral, cap, names[base + index], index) for name, peripheral, cap, base, n in channels(vehicle) for index in range(n) ]
+        for speed, steering, seconds in ((50, 0, 5), (80, 60, 20), (60, -100, 10), (100, 20, 10), (-40, 60, 10)):
+            vehicle.set_property('speed', speed)
+            vehicle.set_property('steering', steering)
+            for i in range(seconds * 50):
+                vehicle.step(0.02)
+                for peripheral, cap, name, index in names:
+                    series.setdefault(name, []).append((vehicle.time, values(peripheral, cap)[index]))
+
+    for delay in (0.03, 0.06):
+        print("I: link delay %.0f ms" % (delay * 1000))
+        for name, (n, naive, predicted) in sorted(evaluate(series, delay).items()):
+            if naive > 0:
+                print("I:   %-24s %6d samples, RMS error %8.3f -> %8.3f (%+.0f%%)" % (name, n, naive, predicted, (predicted - naive) * 100 / naive))
@@ -0,0 +1,205 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Low-overhead sampling profiler.
+
+`SamplingProfiler` runs a background thread which periodically captures
+Python stacks of given threads (`sys._current_frames()`) and keeps
+samples from last `window` seconds. Sampled threads are never stopped,
+only the GIL is briefly taken, so it can run while driving. Usage:
+
+    profiler = SamplingProfiler()
+    profiler.start()
+    ...
+    profiler.stop()
+    profiler.write("profile.folded")    # last `window` seconds
+    print(profiler.summary(seconds=10))  # hot functions in last 10s
+
+Output of `write()` is in "folded stacks" format understood by
+flamegraph tools (FlameGraph's `flamegraph.pl`, speedscope, inferno).
+"""
+import sys
+import threading
+
+from collections import deque
+from time import monotonic, sleep
+
+
+class SamplingProfiler:
+    """
+    Samples threads with given idents (defaults to thread calling
+    constructor, usually the main one) every `interval` seconds.
+    """
+    def __init__(self, threads=None, interval=0.005, window=60):
+        self.threads = list(threads) if threads != None else [threading.get_ident()]
+        self.interval = interval
+        self.window = window
+        self.overhead = 0.0
+        self._samples = deque()
+        self._stacks = {}
+        self._names = {}
+        self._refs = {}
+        self._next_stack = 0
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._thread.join()
+        self._thread = None
+
+    def _stack(self, frame, thread):
+        # Folded stack, root first. Stacks are interned so each sample
+        # is just a (time, id) pair, the id is referenced by one more
+        # sample (see `_release()`).
+        names = []
+        while frame != None:
+            code = frame.f_code
+            names.append("%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        names.append(thread)
+        names.reverse()
+        key = tuple(names)
+        stack = self._stacks.get(key)
+        if stack == None:
+            stack = self._stacks[key] = self._next_stack
+            self._names[stack] = key
+            self._refs[stack] = 0
+            self._next_stack += 1
+        self._refs[stack] += 1
+        return stack
+
+    def _release(self, stack):
+        # Forget stacks no longer referenced by any sample, otherwise the
+        # tables would grow for as long as profiler runs.
+        refs = self._refs[stack] - 1
+        if refs == 0:
+            del self._stacks[self._names.pop(stack)]
+            del self._refs[stack]
+        else:
+            self._refs[stack] = refs
+
+    def _run(self):
+        names = { thread.ident : thread.name for thread in threading.enumerate() }
+        while self._running:
+            started = monotonic()
+            frames = sys._current_frames()
+            with self._lock:
+                for ident in self.threads:
+                    frame = frames.get(ident)
+                    if frame != None:
+                        self._samples.append((started, self._stack(frame, names.get(ident, str(ident)))))
+                while self._samples and self._samples[0][0] < started - self.window:
+                    self._release(self._samples.popleft()[1])
+            del frames
+            elapsed = monotonic() - started
+            self.overhead += elapsed
+            sleep(max(0, self.interval - elapsed))
+
+    def _recent(self, seconds):
+        """
+        Return dictionary of stack tuples to sample counts in last
+        `seconds` (or whole window).
+        """
+        since = monotonic() - (seconds if seconds != None else self.window)
+        counts = {}
+        with self._lock:
+            for time, stack in self._samples:
+                if time >= since:
+                    counts[stack] = counts.get(stack, 0) + 1
+            return { self._names[stack] : count for stack, count in counts.items() }
+
+    def write(self, path, seconds=None):
+        """
+        Write samples from last `seconds` (or whole window) to `path`
+        in folded stacks format. Return number of samples written.
+        """
+        total = 0
+        with open(path, 'w') as f:
+            for stack, count in self._recent(seconds).items():
+                f.write("%s %d\n" % (";".join(stack), count))
+                total += count
+        return total
+
+    def summary(self, seconds=None, top=15):
+        """
+        Return a human readable table of `top` functions with most
+        samples in last `seconds` (or whole window): samples spent in
+        function itself (self) and in function or its callees (total).
+        """
+        own = {}
+        total = {}
+        n = 0
+        for stack, count in self._recent(seconds).items():
+            n += count
+            if len(stack) > 1:
+                own[stack[-1]] = own.get(stack[-1], 0) + count
+            for name in set(stack[1:]):
+                total[name] = total.get(name, 0) + count
+        if n == 0:
+            return "no samples"
+        lines = ["%6s %6s  %s" % ("self", "total", "function")]
+        for name, count in sorted(own.items(), key=lambda each: -each[1])[:top]:
+            lines.append("%5.1f%% %5.1f%%  %s" % (count * 100 / n, total[name] * 100 / n, name))
+        lines.append("%d samples" % n)
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    # Profile simulated vehicle with telemetry statistics and measure
+    # profiler's overhead.
+    from controlminus.simulator import SimulatedVehicle
+    from controlminus.stats import TelemetryStats
+
+    def drive(seconds):
+        vehicle = SimulatedVehicle()
+        stats = TelemetryStats(vehicle, clock=lambda: vehicle.time)
+        vehicle.set_property('speed', 60)
+        steps = 0
+        started = monotonic()
+        while monotonic() - started < seconds:
+            vehicle.step(0.05)
+            steps += 1
+        return steps
+
+    baseline = drive(2)
+    profiler = SamplingProfiler()
+    profiler.start()
+    profiled = drive(2)
+    profiler.stop()
+    print(profiler.summary(top=10))
+    print("I: %.1f%% fewer steps while profiling, sampling took %.1f ms" % ((baseline - profiled) * 100 / baseline, profiler.overhead * 1000))
+    if len(sys.argv) > 1:
+        print("I: wrote %d samples to %s" % (profiler.write(sys.argv[1]), sys.argv[1]))
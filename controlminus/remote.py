@@ -0,0 +1,434 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Remote control of a vehicle over the network.
+
+Protocol is UDP based, each datagram carries exactly one message. Every
+message starts with a header:
+
+    magic     2 bytes, always b'C-'
+    type      uint8, see below
+    session   uint16, chosen randomly by the sender at start
+    sequence  uint32, incremented by the sender for each message
+
+followed by a type-specific payload. All values are in network byte order.
+A message whose sequence number is not newer than the last one received
+from the same sender (and session) is stale and is dropped, so reordered
+or duplicated datagrams never revert a newer command.
+
+Client to server messages:
+
+    SPEED      int8 speed (in percent)
+    STEER      int8 steering (in percent)
+    DRIVE      int8 speed, int8 steering
+    HALT       (no payload)
+    PROFILE    uint8 drive profile, see `Vehicle.Profiles`
+    PING       float64 client's timestamp, answered by PONG
+    SUBSCRIBE  uint8 telemetry rate (per second), 0 to unsubscribe
+
+Server to client messages:
+
+    PONG       float64 timestamp from PING
+    CHANNELS   names of telemetry channels, UTF-8, separated by newline
+    TELEMETRY  float64 server time, float32 value for each channel
+
+Telemetry is sent only to subscribed clients, whenever a peripheral
+reports new values but at most at the subscribed rate. A subscription expires
+unless renewed (by any message) within `RemoteControlServer.expiry`
+seconds. As a safety measure, the vehicle is halted when a client that
+has been driving it does not send any command for
+`RemoteControlServer.timeout` seconds - clients are expected to repeat
+the current command periodically (`RemoteControlClient` does so).
+
+There is no authentication whatsoever, so by default the server listens
+on loopback interface only. Pass host explicitly (like '0.0.0.0') to
+accept commands from other machines, and do so only on a trusted network.
+"""
+import logging
+import struct
+
+from asyncio import DatagramProtocol, TimeoutError, get_event_loop, sleep, wait_for, create_task as spawn
+from random import randrange
+from time import monotonic, time
+
+from controlminus.telemetry import peripherals, channels, channel_names, values
+
+logger = logging.getLogger(__name__)
+
+HOST = '127.0.0.1'
+PORT = 4242
+
+MAGIC = b'C-'
+HEADER = struct.Struct('!2sBHI')
+
+SPEED = 0x01
+STEER = 0x02
+DRIVE = 0x03
+HALT = 0x04
+PROFILE = 0x05
+PING = 0x06
+SUBSCRIBE = 0x07
+
+PONG = 0x81
+CHANNELS = 0x82
+TELEMETRY = 0x83
+
+PAYLOADS = {
+    SPEED : struct.Struct('!b'),
+    STEER : struct.Struct('!b'),
+    DRIVE : struct.Struct('!bb'),
+    HALT : struct.Struct('!'),
+    PROFILE : struct.Struct('!B'),
+    PING : struct.Struct('!d'),
+    SUBSCRIBE : struct.Struct('!B'),
+    PONG : struct.Struct('!d'),
+}
+
+
+def is_newer(sequence, last):
+    """
+    Return True, if `sequence` is newer than `last`, taking wrap-around
+    of 32bit sequence numbers into account.
+    """
+    return 0 < ((sequence - last) & 0xFFFFFFFF) < 0x80000000
+
+
+def clamp(value, lo=-100, hi=100):
+    return max(lo, min(hi, value))
+
+
+class Endpoint(DatagramProtocol):
+    """
+    Common code of both server and client - keeps track of own sequence
+    numbers and drops stale messages.
+    """
+    def __init__(self):
+        self.transport = None
+        self.session = randrange(0x10000)
+        self.sequence = 0
+        self.peers = {}
+
+        self.messages_received = 0
+        self.messages_stale = 0
+        self.messages_invalid = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def send(self, addr, kind, payload=b''):
+        if self.transport == None:
+            return
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self.transport.sendto(HEADER.pack(MAGIC, kind, self.session, self.sequence) + payload, addr)
+
+    def datagram_received(self, data, addr):
+        if len(data) < HEADER.size:
+            self.messages_invalid += 1
+            return
+        magic, kind, session, sequence = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            self.messages_invalid += 1
+            return
+        peer = self.peers.get(addr)
+        if peer != None and peer[0] == session and not is_newer(sequence, peer[1]):
+            self.messages_stale += 1
+            return
+        self.peers[addr] = (session, sequence, monotonic())
+        self.messages_received += 1
+        payload = PAYLOADS.get(kind)
+        try:
+            if payload != None:
+                self.message_received(addr, kind, *payload.unpack_from(data, HEADER.size))
+            else:
+                self.message_received(addr, kind, data[HEADER.size:])
+        except struct.error:
+            self.messages_invalid += 1
+
+    def message_received(self, addr, kind, *args):
+        """
+        Called for each valid message that is not stale. Subclasses
+        override this to handle messages they understand.
+        """
+        pass
+
+
+class RemoteControlServer(Endpoint):
+    """
+    Accepts commands from `RemoteControlClient`s and streams telemetry
+    back. Must be started from within the (running) vehicle event loop.
+    """
+    timeout = 0.5
+    expiry = 5.0
+
+    def __init__(self, vehicle, host=HOST, port=PORT):
+        super().__init__()
+        self.vehicle = vehicle
+        self.host = host
+        self.port = port
+        self.subscribers = {}
+        self._driver = None
+        self._last_command = 0
+        self._tasks = []
+        self._channels = None
+        self._channel_names = None
+        self._handler_ids = []
+
+    async def start(self):
+        # Telemetry channels of each capability, in order in which
+        # they're sent.
+        self._channels = [(peripheral, cap) for name, peripheral, cap, base, n in channels(self.vehicle)]
+        self._channel_names = channel_names(self.vehicle)
+        self._telemetry = struct.Struct('!d%df' % len(self._channel_names))
+        await get_event_loop().create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        for name, peripheral in peripherals(self.vehicle):
+            self._handler_ids.append((peripheral, peripheral.connect('notify', self.on_peripheral_notify)))
+        self._tasks = [ spawn(self.watchdog()) ]
+        logger.info("remote control server listening on %s:%d", self.host, self.port)
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for peripheral, handler_id in self._handler_ids:
+            peripheral.disconnect(handler_id)
+        self._handler_ids = []
+        if self.transport != None:
+            self.transport.close()
+
+    def message_received(self, addr, kind, *args):
+        if kind in (SPEED, STEER, DRIVE, HALT, PROFILE):
+            self._driver = addr
+            self._last_command = monotonic()
+        if kind == SPEED:
+            self.vehicle.set_property('speed', clamp(args[0]))
+        elif kind == STEER:
+            self.vehicle.set_property('steering', clamp(args[0]))
+        elif kind == DRIVE:
+            self.vehicle.set_property('speed', clamp(args[0]))
+            self.vehicle.set_property('steering', clamp(args[1]))
+        elif kind == HALT:
+            self.vehicle.set_property('speed', 0)
+        elif kind == PROFILE:
+            if args[0] < len(self.vehicle.Profiles):
+                self.vehicle.set_property('profile', args[0])
+        elif kind == PING:
+            self.send(addr, PONG, PAYLOADS[PONG].pack(args[0]))
+        elif kind == SUBSCRIBE:
+            if args[0] > 0:
+                self.subscribers[addr] = [1 / args[0], 0]
+                self.send(addr, CHANNELS, '\n'.join(self._channel_names).encode('utf-8'))
+            else:
+                self.subscribers.pop(addr, None)
+        else:
+            self.messages_invalid += 1
+
+    async def watchdog(self):
+        while True:
+            await sleep(self.timeout / 4)
+            now = monotonic()
+            if self._driver != None and now - self._last_command > self.timeout:
+                logger.warning("remote control client %s timed out, halting", self._driver)
+                self._driver = None
+                self.vehicle.set_property('speed', 0)
+            for addr, peer in list(self.peers.items()):
+                if now - peer[2] > self.expiry:
+                    del self.peers[addr]
+                    self.subscribers.pop(addr, None)
+
+    def on_peripheral_notify(self, peripheral):
+        if len(self.subscribers) == 0:
+            return
+        now = monotonic()
+        packet = None
+        for addr, subscriber in self.subscribers.items():
+            interval, due = subscriber
+            if due <= now:
+                if packet == None:
+                    packet = self._telemetry.pack(time(), *[value for peripheral, cap in self._channels for value in values(peripheral, cap)])
+                self.send(addr, TELEMETRY, packet)
+                subscriber[1] = max(due + interval, now)
+
+
+class RemoteControlClient(Endpoint):
+    """
+    Reference client. Usage:
+
+        client = RemoteControlClient('vehicle.local')
+        await client.connect()
+        client.subscribe(10)
+        client.drive(50, -20)
+        ...
+        client.halt()
+        client.close()
+
+    Latest telemetry values are available in `telemetry` dictionary keyed
+    by channel name.
+    """
+    def __init__(self, host, port=PORT, keepalive=0.1):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.channels = []
+        self.telemetry = {}
+        self.telemetry_time = None
+        self._command = None
+        self._pings = {}
+        self._keepalive_task = None
+
+    async def connect(self):
+        await get_event_loop().create_datagram_endpoint(lambda: self, remote_addr=(self.host, self.port))
+        self._keepalive_task = spawn(self.keep_alive())
+
+    def close(self):
+        if self._keepalive_task != None:
+            self._keepalive_task.cancel()
+        if self.transport != None:
+            self.transport.close()
+
+    def command(self, kind, *args):
+        self._command = (kind, args)
+        self.send(None, kind, PAYLOADS[kind].pack(*args))
+
+    def speed(self, pct):
+        self.command(SPEED, clamp(pct))
+
+    def steer(self, pct):
+        self.command(STEER, clamp(pct))
+
+    def drive(self, speed, steering):
+        self.command(DRIVE, clamp(speed), clamp(steering))
+
+    def halt(self):
+        self.command(HALT)
+        self._command = None
+
+    def profile(self, profile):
+        self.send(None, PROFILE, PAYLOADS[PROFILE].pack(profile))
+
+    def subscribe(self, rate):
+        self.send(None, SUBSCRIBE, PAYLOADS[SUBSCRIBE].pack(rate))
+
+    async def ping(self, timeout=1.0):
+        """
+        Return round-trip time (in seconds) or None if no reply
+        arrived within timeout.
+        """
+        sent = monotonic()
+        future = get_event_loop().create_future()
+        self._pings[sent] = future
+        self.send(None, PING, PAYLOADS[PING].pack(sent))
+        try:
+            return await wait_for(future, timeout)
+        except TimeoutError:
+            return None
+        finally:
+            self._pings.pop(sent, None)
+
+    async def keep_alive(self):
+        while True:
+            await sleep(self.keepalive)
+            if self._command != None:
+                kind, args = self._command
+                self.send(None, kind, PAYLOADS[kind].pack(*args))
+
+    def message_received(self, addr, kind, *args):
+        if kind == PONG:
+            future = self._pings.get(args[0])
+            if future != None and not future.done():
+                future.set_result(monotonic() - args[0])
+        elif kind == CHANNELS:
+            self.channels = args[0].decode('utf-8').split('\n')
+        elif kind == TELEMETRY:
+            if len(self.channels) > 0:
+                decoded = struct.unpack_from('!d%df' % len(self.channels), args[0])
+                self.telemetry_time = decoded[0]
+                self.telemetry = dict(zip(self.channels, decoded[1:]))
+
+
+if __name__ == '__main__':
+    # Loopback benchmark with simulated vehicle or a simple monitor
+    # of a remote vehicle, use:
+    #
+    #     python3 -m controlminus.remote benchmark [COUNT]
+    #     python3 -m controlminus.remote monitor HOST [PORT]
+    #
+    import sys
+    import asyncio
+    from controlminus.simulator import SimulatedVehicle
+
+    async def benchmark(count):
+        vehicle = SimulatedVehicle()
+        server = RemoteControlServer(vehicle, '127.0.0.1', 0)
+        await server.start()
+        simulation = spawn(vehicle.run(20))
+        client = RemoteControlClient('127.0.0.1', server.port)
+        await client.connect()
+
+        rtts = []
+        for i in range(count):
+            rtts.append(await client.ping())
+        rtts = sorted(rtt for rtt in rtts if rtt != None)
+        print("I: latency (RTT) over %d pings: min %.0fus, median %.0fus, 99%% %.0fus, max %.0fus" % (len(rtts), rtts[0] * 1e6, rtts[len(rtts) // 2] * 1e6, rtts[int(len(rtts) * 0.99)] * 1e6, rtts[-1] * 1e6))
+
+        received = server.messages_received
+        started = monotonic()
+        for i in range(count):
+            client.drive(i % 100, 0)
+            await sleep(0)
+        await client.ping()
+        elapsed = monotonic() - started
+        print("I: throughput: %d commands in %.3fs (%.0f commands/s), %d received" % (count, elapsed, count / elapsed, server.messages_received - received - 1))
+
+        stale = server.messages_stale
+        sequence = client.sequence
+        for i in range(100):
+            client.sequence = sequence - i - 2
+            client.send(None, SPEED, PAYLOADS[SPEED].pack(-100))
+        client.sequence = sequence + 100
+        await client.ping()
+        print("I: %d of 100 reordered commands dropped as stale, speed is %d" % (server.messages_stale - stale, vehicle.get_property('speed')))
+
+        client.subscribe(20)
+        await sleep(1)
+        print("I: telemetry: %s" % client.telemetry)
+
+        client.close()
+        server.stop()
+        simulation.cancel()
+
+    async def monitor(host, port):
+        client = RemoteControlClient(host, port)
+        await client.connect()
+        client.subscribe(5)
+        while True:
+            await sleep(1)
+            print("%s: %s (RTT %s)" % (client.telemetry_time, client.telemetry, await client.ping()))
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'monitor':
+        main = monitor(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else PORT)
+    else:
+        main = benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    asyncio.get_event_loop().run_until_complete(main)
@@ -0,0 +1,423 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Vehicle session: everything the application does with the vehicle and
+controller, without any UI.
+
+`VehicleSession` (re)connects the hub, passes controller input to the
+vehicle, keeps telemetry statistics, sensor bus and subscriptions of
+telemetry view and runs optional telemetry consumers (recording, remote
+control server, shared memory publisher and analytics). `VehicleApp`
+shows it in a Gtk window, soak test (`controlminus.soak`) runs it as is
+against a simulated hub.
+"""
+from time import monotonic, strftime
+
+from controlminus.remote import RemoteControlServer, HOST
+from controlminus.export import TelemetryExporter
+from controlminus.shm import TelemetryPublisher
+from controlminus.analytics import AnalyticsExecutor, channel_statistics
+from controlminus.stats import TelemetryStats
+from controlminus.bus import SensorBus
+from controlminus.startup import Startup
+from controlminus.prediction import Predictor
+
+def scale(val, src, dst):
+    """
+    Scale the given value from the scale of src to the scale of dst.
+
+    val: float or int
+    src: tuple
+    dst: tuple
+
+    example: print(scale(99, (0.0, 99.0), (-1.0, +1.0)))
+    """
+    return round((float(val - src[0]) / (src[1] - src[0])) * (dst[1] - dst[0]) + dst[0])
+
+class VehicleSession:
+    """
+    Vehicle and controller together with everything running in vehicle
+    (control) loop, see module documentation.
+
+    Subclasses provide the vehicle and controller by implementing
+    `create_vehicle()`, `create_controller()`, `connect_vehicle()` and
+    `disconnect_vehicle()`. UI shows the session by overriding `call_ui()`,
+    `show()`, `clear_telemetry_view()`, `add_telemetry_view()`,
+    `show_attitude()` and `show_stick()`, without UI these do nothing
+    (telemetry view is just a dictionary of latest values).
+    """
+    def __init__(self):
+        self.remote_host = HOST
+        self.startup = Startup()
+        self.vehicle = None
+        self.supervisor = None
+        self.controller = None
+        self.control = None
+        self.commands = None
+        self.sensors = None
+        self.bus = None
+        self.stats = None
+        self.attitude = None
+        self.telemetry_subscriptions = []
+        self.telemetry_rows = {}
+        self.controller_connected = False
+        self.initialized = False
+        self.exporter = None
+        self.remote = None
+        self.publisher = None
+        self.analytics = None
+        self.analytics_result = None
+
+    def start_session(self):
+        """
+        Create the vehicle and start connecting to it and discovering
+        the controller.
+        """
+        with self.startup.phase('vehicle'):
+            self.call_control_sync(self.setup_vehicle)
+        self.spawn_control(self.startup.run('connect', self.connect_task()), 'connect')
+        self.spawn_control(self.controller_task(), 'controller')
+
+    async def stop_session(self):
+        """
+        Stop all telemetry consumers and disconnect from the vehicle.
+        """
+        if self.remote != None:
+            self.remote.stop()
+        if self.publisher != None:
+            self.publisher.stop()
+        if self.exporter != None:
+            await self.exporter.stop()
+        if self.analytics != None:
+            await self.analytics.stop()
+        await self.disconnect_vehicle()
+
+    def setup_vehicle(self):
+        """
+        Create vehicle. Called in control thread.
+        """
+        self.vehicle = self.create_vehicle()
+        self.supervisor = self.vehicle.supervisor
+        self.supervisor.install()
+        self.vehicle.connect('connected', self.on_connected)
+        self.vehicle.connect('initialized', self.on_initialized)
+        self.vehicle.connect('disconnected', self.on_disconnected)
+        self.stats = TelemetryStats(self.vehicle)
+        # Fed by on_vehicle_position_changed() so prediction always
+        # includes the values being shown.
+        self.attitude = Predictor(self.vehicle, connect=False)
+
+    async def controller_task(self):
+        """
+        Setup controller (remote). Gamepad is picked up whenever
+        it is connected.
+        """
+        with self.startup.phase('controller'):
+            self.controller = self.create_controller()
+            if self.initialized:
+                self.connect_controller()
+        await self.controller.dispatch()
+
+    def connect_controller(self):
+        if not self.controller_connected:
+            self.controller_connected = True
+            self.controller.connect("notify::abs-l-x", self.on_remote_x_changed)
+            self.controller.connect("notify::abs-r-y", self.on_remote_y_changed)
+
+    def create_vehicle(self):
+        raise NotImplementedError()
+
+    def create_controller(self):
+        raise NotImplementedError()
+
+    async def connect_vehicle(self):
+        """
+        Connect to the hub (and initialize it).
+        """
+        raise NotImplementedError()
+
+    async def disconnect_vehicle(self):
+        raise NotImplementedError()
+
+    def call_control(self, func, *args):
+        """
+        Call `func` in control thread (if any).
+        """
+        if self.control != None:
+            self.control.call(func, *args)
+        else:
+            func(*args)
+
+    def call_control_sync(self, func, *args):
+        """
+        Call `func` in control thread (if any) and wait for
+        the result.
+        """
+        if self.control != None:
+            return self.control.call_sync(func, *args)
+        else:
+            return func(*args)
+
+    def spawn_control(self, coro, category='default'):
+        """
+        Spawn coroutine in control thread (if any) under vehicle's
+        supervisor.
+        """
+        self.call_control(self.supervisor.spawn, coro, category)
+
+    def call_ui(self, func, *args):
+        """
+        Call `func` in UI (main) thread.
+        """
+        func(*args)
+
+    def set_vehicle_property(self, name, value):
+        """
+        Set vehicle's property from UI thread.
+        """
+        if self.commands != None:
+            self.commands.put(name, value)
+        else:
+            self.vehicle.set_property(name, value)
+
+    def show(self, page):
+        """
+        Show given page ("connecting", "initializing", "dashboard"
+        or "shuttingdown").
+        """
+        pass
+
+    async def connect_task(self):
+        self.call_ui(self.show, "connecting")
+        await self.connect_vehicle()
+
+        # Connect task runs again on each reconnect but peripherals stay
+        # the same, connect to them only once. In threaded mode,
+        # notifications are coalesced and passed to UI thread which then
+        # publishes them to the bus.
+        if self.bus == None:
+            self.bus = SensorBus(self.vehicle, connect=self.sensors == None)
+            if self.sensors != None:
+                for name, peripheral in self.vehicle.peripherals.items():
+                    peripheral.connect('notify', self.on_vehicle_sensor_reading_changed_threaded)
+        self.call_ui(self.setup_telemetry)
+
+    def setup_telemetry(self):
+        # Rebuild telemetry view from scratch, may be called repeatedly
+        for subscription in self.telemetry_subscriptions:
+            self.bus.unsubscribe(subscription)
+        self.telemetry_subscriptions = []
+        self.clear_telemetry_view()
+        for name, peripheral in self.vehicle.peripherals.items():
+            update = self.add_telemetry_view(name, peripheral)
+            if peripheral.capabilities:
+                self.telemetry_subscriptions.append(self.bus.subscribe(update, *["%s.%s" % (name, cap.name) for cap in peripheral.capabilities]))
+        if self.vehicle.peripherals.get('position') != None:
+            self.telemetry_subscriptions.append(self.bus.subscribe(self.on_vehicle_position_changed, 'position.sense_pos.0', 'position.sense_pos.1', 'position.sense_pos.2'))
+
+    def clear_telemetry_view(self):
+        self.telemetry_rows = {}
+
+    def add_telemetry_view(self, name, peripheral):
+        """
+        Add rows of given peripheral to telemetry view, return bus
+        subscriber updating them.
+        """
+        rows = self.telemetry_rows
+        keys = ["%s.%s" % (name, cap.name) for cap in peripheral.capabilities]
+        rows[name] = ''
+        for key in keys:
+            rows[key] = ''
+        def update(time, *cap_values):
+            for key, cap_value in zip(keys, cap_values):
+                rows[key] = str(cap_value)
+        return update
+
+    def show_attitude(self, yaw, pitch, roll):
+        pass
+
+    def show_stick(self, name, value):
+        """
+        Show controller's stick position, `name` is "x" (steering)
+        or "y" (speed).
+        """
+        pass
+
+    def start_recording(self):
+        """
+        Start recording telemetry to a file in current directory.
+        Return False if recording is not available.
+        """
+        path = strftime("telemetry-%Y%m%d-%H%M%S.parquet")
+        try:
+            self.exporter = TelemetryExporter(self.vehicle, path)
+        except ImportError as e:
+            print("E: %s" % e)
+            return False
+        self.call_control(self.exporter.start)
+        print("I: recording telemetry to %s" % path)
+        return True
+
+    def stop_recording(self):
+        self.spawn_control(self.exporter.stop(), 'record')
+        self.exporter = None
+
+    def start_remote(self):
+        """
+        Start remote control server.
+        """
+        self.remote = RemoteControlServer(self.vehicle, self.remote_host)
+        self.spawn_control(self.remote.start(), 'remote')
+
+    def stop_remote(self):
+        self.call_control(self.remote.stop)
+        self.remote = None
+
+    def create_publisher(self):
+        return TelemetryPublisher(self.vehicle)
+
+    def start_publishing(self, failed=None):
+        """
+        Start publishing telemetry to shared memory. If another process
+        publishes already, print an error and call `failed` in UI thread.
+        """
+        if self.publisher == None:
+            self.publisher = self.create_publisher()
+        def start():
+            try:
+                self.publisher.start()
+            except FileExistsError as e:
+                print("E: %s" % e)
+                if failed != None:
+                    self.call_ui(failed)
+        self.call_control(start)
+
+    def stop_publishing(self):
+        self.call_control(self.publisher.stop)
+
+    def start_analyzing(self):
+        """
+        Start computing telemetry statistics (in worker processes
+        if there's more than one CPU).
+        """
+        self.analytics = AnalyticsExecutor(self.vehicle)
+        self.analytics.subscribe(channel_statistics, self.on_analytics_result)
+        self.call_control(self.analytics.start)
+        print("I: analyzing telemetry")
+
+    def stop_analyzing(self):
+        """
+        Stop computing telemetry statistics, print statistics of
+        the last analyzed batch.
+        """
+        async def stop_task(analytics):
+            await analytics.stop()
+            self.call_ui(self.on_analytics_stopped, analytics)
+        self.spawn_control(stop_task(self.analytics), 'analyze')
+        self.analytics = None
+
+    def on_analytics_result(self, result):
+        # Called in vehicle loop
+        self.analytics_result = result
+
+    def on_analytics_stopped(self, analytics):
+        print("I: %d samples analyzed, %d dropped" % (analytics.samples_analyzed, analytics.samples_dropped))
+        if self.analytics_result != None:
+            for name, (count, mean, stddev, minimum, maximum) in sorted(self.analytics_result.items()):
+                print("   %-24s count=%d mean=%.4g stddev=%.4g min=%.4g max=%.4g" % (name, count, mean, stddev, minimum, maximum))
+        self.analytics_result = None
+
+    def on_remote_x_changed(self, controller, prop):
+        v = self.controller.get_property(prop.name)
+        v = scale(v, (0, 255), (-100, 100))
+        self.vehicle.set_property('steering', v)
+        self.call_ui(self.show_stick, "x", v)
+
+    def on_remote_y_changed(self, controller, prop):
+        v = self.controller.get_property(prop.name)
+        v = -1 * scale(v, (0, 255), (-100, 100))
+        self.vehicle.set_property('speed', v)
+        self.call_ui(self.show_stick, "y", v)
+
+    def on_commands(self, commands):
+        """
+        Called in control thread with commands (property values) set
+        from UI.
+        """
+        for name, value in commands.items():
+            self.vehicle.set_property(name, value)
+
+    def on_vehicle_sensor_reading_changed_threaded(self, peripheral):
+        """
+        Called in control thread when sensor values change, passes them
+        to UI thread.
+        """
+        self.sensors.put(peripheral, monotonic())
+
+    def on_sensors(self, peripherals):
+        """
+        Called in UI thread with peripherals whose values changed.
+        Values are read directly, values of multi-dataset
+        capabilities may thus come from different notifications,
+        which is fine for display.
+        """
+        for peripheral, time in peripherals.items():
+            self.bus.publish(peripheral, time)
+
+    def on_vehicle_position_changed(self, time, yaw, pitch, roll):
+        # Show where the vehicle is heading now rather than when hub
+        # sampled the values
+        angles = []
+        for index, angle in enumerate((yaw, pitch, roll)):
+            name = 'position.sense_pos.%d' % index
+            self.attitude.add(name, angle, time)
+            angles.append(self.attitude.predict(name))
+        if all(angle == angle for angle in angles):
+            yaw, pitch, roll = [ int(round(angle)) for angle in angles ]
+        self.show_attitude(yaw, pitch, roll)
+
+    def on_connected(self, vehicle):
+        """
+        Called when hub is connected
+        """
+        self.call_ui(self.show, "initializing")
+
+    def on_initialized(self, vehicle):
+        """
+        Called when hub is initialized
+        """
+        self.call_ui(self.show, "dashboard")
+        self.initialized = True
+        if self.startup.mark('drivable'):
+            print("I: startup timing:\n%s" % self.startup.report())
+
+        # Hub is initialized again after each reconnect, connect input
+        # handlers only the first time. Controller may not be set up yet,
+        # controller task connects it then.
+        if self.controller != None:
+            self.connect_controller()
+
+    def on_disconnected(self, vehicle):
+        """
+        Called when hub disconnects.
+        """
+        # Make sure only one connect task runs at a time
+        self.spawn_control(self.supervisor.restart('connect', self.connect_task), 'reconnect')
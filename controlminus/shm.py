@@ -0,0 +1,425 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Publishing vehicle's telemetry to other (local) processes through
+shared memory.
+
+The publisher writes into a shared memory segment (by default named
+`controlminus-telemetry`, i.e., `/dev/shm/controlminus-telemetry` on Linux)
+with following layout (native byte order):
+
+    magic       8 bytes, b'C-TELEM2'
+    channels    uint32, number of channels
+    capacity    uint32, number of samples in the ring
+    names_size  uint32, size of channel names block (in bytes)
+    pid         uint32, process id of the publisher
+    sequence    uint64, snapshot sequence number (see below)
+    head        uint64, total number of samples written to the ring
+    cursor      uint64, total number of samples written or being written
+                to the ring
+    names       channel names, UTF-8, separated by newline, padded
+                to 8 bytes
+    snapshot    float64 time followed by float64 value for each channel
+    ring        `capacity` samples, each three float64: time, channel
+                index and value
+
+The snapshot is protected by a sequence lock: the publisher increments
+`sequence` before and after updating it, so it is odd while an update is
+in progress. A reader copies the snapshot and accepts the copy only if
+`sequence` was even and did not change meanwhile. Ring samples are
+overwritten only when the ring wraps around. Before writing a batch of
+samples the publisher advances `cursor` past the batch, writes the
+samples and only then advances `head` to `cursor`. A reader remembers how
+many samples it has already read, copies samples up to `head` and accepts
+only those not overwritten meanwhile, i.e., those at positions at least
+`cursor - capacity` where `cursor` is read after copying.
+
+Readers map the segment read-only and never write to it so the cost of
+publishing does not depend on number of readers. Times are seconds since
+epoch.
+"""
+import mmap
+import os
+import struct
+
+from multiprocessing import shared_memory
+from time import time
+
+from controlminus.telemetry import peripherals, channels, channel_names, values
+
+NAME = 'controlminus-telemetry'
+
+MAGIC = b'C-TELEM2'
+HEADER = struct.Struct('8sIIIIQQQ')
+SEQUENCE_OFFSET = 24
+HEAD_OFFSET = 32
+CURSOR_OFFSET = 40
+
+
+def map_segment(name):
+    """
+    Map shared memory segment `name` read-only and return the mmap.
+    """
+    # Map the segment directly rather than using SharedMemory, whose
+    # resource tracker would unlink the segment when this process exits.
+    fd = os.open('/dev/shm/' + name, os.O_RDONLY)
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _owner(name):
+    """
+    Return pid of the live publisher of segment `name` or None if there's
+    none (segment is left over from a crashed run or is not a telemetry
+    segment).
+    """
+    try:
+        segment = map_segment(name)
+    except OSError:
+        return None
+    try:
+        if segment.size() < HEADER.size:
+            return None
+        magic, _, _, _, pid, _, _, _ = HEADER.unpack_from(segment, 0)
+    finally:
+        segment.close()
+    if magic != MAGIC or pid == 0 or pid == os.getpid() or not _is_alive(pid):
+        return None
+    return pid
+
+
+class _Layout:
+    """
+    Views of the shared memory segment.
+    """
+    def __init__(self, buf, n_channels, capacity, names_size):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        snapshot = HEADER.size + names_size
+        ring = snapshot + 8 * (1 + n_channels)
+        self.counters = buf[SEQUENCE_OFFSET:CURSOR_OFFSET + 8].cast('Q')
+        self.names = buf[HEADER.size:snapshot]
+        self.snapshot = buf[snapshot:ring].cast('d')
+        self.ring = buf[ring:ring + 8 * 3 * capacity].cast('d')
+
+    @staticmethod
+    def size(n_channels, capacity, names_size):
+        return HEADER.size + names_size + 8 * (1 + n_channels) + 8 * 3 * capacity
+
+    def release(self):
+        for view in (self.counters, self.names, self.snapshot, self.ring):
+            view.release()
+
+
+class TelemetryPublisher:
+    """
+    Publishes telemetry of given vehicle to a shared memory segment, see
+    module documentation. Usage:
+
+        publisher = TelemetryPublisher(vehicle)
+        publisher.start()
+        ...
+        publisher.stop()
+    """
+    def __init__(self, vehicle, name=NAME, capacity=65536):
+        self.vehicle = vehicle
+        self.name = name
+        self.capacity = capacity
+        self._shm = None
+        self._layout = None
+        self._publishing = False
+        self._handler_ids = []
+
+        self._channel_names = channel_names(vehicle)
+        self._channel_ids = { (peripheral, cap) : base for name, peripheral, cap, base, n in channels(vehicle) }
+        self._batch_sizes = {}
+        for name, peripheral, cap, base, n in channels(vehicle):
+            self._batch_sizes[peripheral] = self._batch_sizes.get(peripheral, 0) + n
+
+    def start(self):
+        names = '\n'.join(self._channel_names).encode('utf-8')
+        names_size = (len(names) + 7) & ~7
+        n = len(self._channel_names)
+        try:
+            self._shm = shared_memory.SharedMemory(self.name, create=True, size=_Layout.size(n, self.capacity, names_size))
+        except FileExistsError:
+            owner = _owner(self.name)
+            if owner != None:
+                raise FileExistsError("telemetry segment %s is in use by process %d" % (self.name, owner))
+            # Left over from previous (crashed) run
+            stale = shared_memory.SharedMemory(self.name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(self.name, create=True, size=_Layout.size(n, self.capacity, names_size))
+        HEADER.pack_into(self._shm.buf, 0, MAGIC, n, self.capacity, names_size, os.getpid(), 0, 0, 0)
+        self._layout = _Layout(self._shm.buf, n, self.capacity, names_size)
+        self._layout.names[:len(names)] = names
+        for name, peripheral in peripherals(self.vehicle):
+            self._handler_ids.append((peripheral, peripheral.connect('notify', self.on_peripheral_notify)))
+            for cap in peripheral.capabilities:
+                self._write_snapshot(peripheral, cap, time())
+        self._publishing = True
+
+    def stop(self):
+        if not self._publishing:
+            return
+        self._publishing = False
+        for peripheral, handler_id in self._handler_ids:
+            peripheral.disconnect(handler_id)
+        self._handler_ids = []
+        self._layout.release()
+        self._layout = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def _write_snapshot(self, peripheral, cap, now):
+        snapshot = self._layout.snapshot
+        channel = self._channel_ids[(peripheral, cap)]
+        for value in values(peripheral, cap):
+            snapshot[1 + channel] = value
+            channel += 1
+        snapshot[0] = now
+
+    def on_peripheral_notify(self, peripheral):
+        if not self._publishing:
+            return
+        now = time()
+        layout = self._layout
+        counters = layout.counters
+        ring = layout.ring
+        capacity = layout.capacity
+        head = counters[1]
+
+        # Announce samples about to be overwritten, append to ring...
+        counters[2] = head + self._batch_sizes[peripheral]
+        for cap in peripheral.capabilities:
+            channel = self._channel_ids[(peripheral, cap)]
+            for value in values(peripheral, cap):
+                slot = 3 * (head % capacity)
+                ring[slot] = now
+                ring[slot + 1] = channel
+                ring[slot + 2] = value
+                head += 1
+                channel += 1
+        counters[1] = head
+
+        # ...and update snapshot.
+        counters[0] += 1
+        for cap in peripheral.capabilities:
+            self._write_snapshot(peripheral, cap, now)
+        counters[0] += 1
+
+
+class TelemetryReader:
+    """
+    Reads telemetry published by `TelemetryPublisher` (possibly in another
+    process). Usage:
+
+        reader = TelemetryReader()
+        sequence, time, values = reader.snapshot() or (None, None, None)
+        for time, channel, value in reader.samples():
+            print(time, reader.channels[channel], value)
+        reader.close()
+    """
+    def __init__(self, name=NAME):
+        self._mmap = map_segment(name)
+        self._buf = memoryview(self._mmap)
+        magic, n_channels, capacity, names_size, _, _, _, _ = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not a telemetry segment" % name)
+        self._layout = _Layout(self._buf, n_channels, capacity, names_size)
+        self.channels = bytes(self._layout.names).rstrip(b'\0').decode('utf-8').split('\n')
+        self.position = self._layout.counters[1]
+        self.samples_lost = 0
+
+    def close(self):
+        if getattr(self, '_layout', None) != None:
+            self._layout.release()
+            self._layout = None
+        self._buf.release()
+        self._mmap.close()
+
+    def snapshot(self, retries=10000):
+        """
+        Return (sequence, time, values) tuple with consistent latest
+        values of all channels, or None if no consistent copy could be
+        made in `retries` attempts (for example, because the publisher
+        died in the middle of an update).
+        """
+        counters = self._layout.counters
+        snapshot = self._layout.snapshot
+        for attempt in range(retries):
+            sequence = counters[0]
+            if sequence & 1:
+                continue
+            copy = snapshot.tolist()
+            if counters[0] == sequence:
+                return (sequence, copy[0], copy[1:])
+        return None
+
+    def samples(self):
+        """
+        Return list of (time, channel index, value) samples published since
+        last call. If reader was too slow and some samples has been
+        overwritten, they are skipped and counted in `samples_lost`.
+        """
+        counters = self._layout.counters
+        ring = self._layout.ring
+        capacity = self._layout.capacity
+        head = counters[1]
+        start = max(self.position, head - capacity)
+        self.samples_lost += start - self.position
+        result = []
+        for position in range(start, head):
+            slot = 3 * (position % capacity)
+            result.append((ring[slot], int(ring[slot + 1]), ring[slot + 2]))
+        # Discard samples (possibly) overwritten while copying
+        overwritten = min(counters[2] - capacity - start, len(result))
+        if overwritten > 0:
+            self.samples_lost += overwritten
+            result = result[overwritten:]
+        self.position = head
+        return result
+
+
+if __name__ == '__main__':
+    # Show telemetry published by running application or, with `benchmark`,
+    # measure the cost of publishing with increasing number of readers:
+    #
+    #     python3 -m controlminus.shm
+    #     python3 -m controlminus.shm benchmark
+    #
+    # With `stress`, check that a reader never returns a sample that has
+    # been overwritten while it was copying, using a tiny ring and a
+    # publisher writing as fast as it can. Exit status is non-zero if
+    # any corrupted sample was seen:
+    #
+    #     python3 -m controlminus.shm stress [SECONDS]
+    #
+    import sys
+    from multiprocessing import Process, Event
+    from time import sleep, thread_time
+    from types import SimpleNamespace
+    from controlminus.simulator import SimulatedVehicle, SimulatedPeripheral
+
+    def read(name, stop):
+        # Poll at 1kHz, much faster than any practical consumer
+        reader = TelemetryReader(name)
+        while not stop.is_set():
+            reader.snapshot()
+            reader.samples()
+            sleep(0.001)
+        reader.close()
+
+    def benchmark(name='controlminus-telemetry-benchmark', steps=20000):
+        vehicle = SimulatedVehicle()
+        vehicle.set_property('speed', 50)
+        publisher = TelemetryPublisher(vehicle, name)
+        publisher.start()
+        for n_readers in (0, 1, 4):
+            stop = Event()
+            readers = [Process(target=read, args=(name, stop)) for i in range(n_readers)]
+            for reader in readers:
+                reader.start()
+            sleep(0.5)
+            # Measure CPU time of publisher, wall-clock time depends
+            # on how many CPUs readers compete for.
+            started = thread_time()
+            for i in range(steps):
+                vehicle.step(0.05)
+            elapsed = thread_time() - started
+            stop.set()
+            for reader in readers:
+                reader.join()
+            print("I: %d readers: %.1f us of CPU time per step (%d notifications)" % (n_readers, elapsed / steps * 1e6, len(vehicle.peripherals)))
+        publisher.stop()
+
+    def publish(name, capacity, ready, stop):
+        # Sample at position `p` in the ring is channel `p % 3` with
+        # value `p // 3`, so reader can tell whether it is what it
+        # should be.
+        counter = SimulatedPeripheral('counter', ('sense_pos', 3))
+        publisher = TelemetryPublisher(SimpleNamespace(peripherals={ 'counter' : counter }), name, capacity)
+        publisher.start()
+        ready.set()
+        n = 0
+        while not stop.is_set():
+            counter.update(sense_pos=[n, n, n])
+            n += 1
+        publisher.stop()
+
+    def stress(duration, name='controlminus-telemetry-stress', capacity=16):
+        ready = Event()
+        stop = Event()
+        writer = Process(target=publish, args=(name, capacity, ready, stop))
+        writer.start()
+        ready.wait()
+        reader = TelemetryReader(name)
+        checked = 0
+        corrupted = 0
+        finish = time() + duration
+        while time() < finish:
+            samples = reader.samples()
+            # Samples returned are the last ones before `position`
+            position = reader.position - len(samples)
+            for t, channel, value in samples:
+                if channel != position % 3 or value != position // 3:
+                    corrupted += 1
+                position += 1
+            checked += len(samples)
+        stop.set()
+        writer.join()
+        reader.close()
+        print("I: %d samples checked, %d lost, %d corrupted" % (checked, reader.samples_lost, corrupted))
+        return corrupted == 0
+
+    def monitor(name=NAME):
+        reader = TelemetryReader(name)
+        while True:
+            snapshot = reader.snapshot()
+            if snapshot == None:
+                print("W: no consistent snapshot, publisher stuck or dead?")
+                sleep(1)
+                continue
+            sequence, t, values = snapshot
+            print("%d %.3f: %s" % (sequence, t, ', '.join('%s=%g' % each for each in zip(reader.channels, values))))
+            sleep(1)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'stress':
+        sys.exit(0 if stress(float(sys.argv[2]) if len(sys.argv) > 2 else 10) else 1)
+    else:
+        monitor(*sys.argv[1:])
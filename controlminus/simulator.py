@@ -0,0 +1,262 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Simulated vehicle for benchmarks, demos and testing without a hub.
+
+`SimulatedVehicle` mimics (the relevant part of) `controlminus.model.Vehicle`
+interface - it has the same peripherals with the same capabilities, supports
+`speed` and `steering` (and `profile`) properties and `notify` signals - but
+does not require bricknil nor a Bluetooth connection. Calling `step()`
+advances the simulation and notifies about changed sensor values, `run()`
+does so in real time.
+
+Motors count (simulated) BLE writes.
+"""
+from asyncio import sleep
+from enum import Enum
+from math import sin, cos, radians, degrees
+from types import SimpleNamespace
+
+from controlminus.actuator import Actuators
+from controlminus.snapshot import SensorStore
+
+capability = Enum('capability', ['sense_speed', 'sense_load', 'sense_power', 'sense_pos', 'sense_grv', 'sense_rot', 'sense_l'])
+
+
+class SimulatedPeripheral:
+    def __init__(self, name, *caps):
+        """
+        `caps` are (capability name, number of datasets) tuples.
+        """
+        self.name = name
+        self.capabilities = [capability[cap] for cap, n in caps]
+        self.datasets = { capability[cap] : (n, 4) for cap, n in caps }
+        self.value = { capability[cap] : [0] * n if n > 1 else 0 for cap, n in caps }
+        self._handlers = {}
+        self._handler_id = 0
+
+    def __getattr__(self, name):
+        # Allow accessing values as attributes, like `motor_a.sense_speed`
+        if name.startswith('sense_'):
+            return self.value[capability[name]]
+        raise AttributeError(name)
+
+    def connect(self, signal, handler, *args):
+        self._handler_id += 1
+        self._handlers[self._handler_id] = (signal, handler, args)
+        return self._handler_id
+
+    def disconnect(self, handler_id):
+        del self._handlers[handler_id]
+
+    def update(self, **values):
+        """
+        Set values of given capabilities and notify.
+        """
+        for name, value in values.items():
+            self.value[capability[name]] = value
+        for signal, handler, args in list(self._handlers.values()):
+            if signal == 'notify':
+                handler(self, *args)
+
+
+class SimulatedMotor(SimulatedPeripheral):
+    def __init__(self, name, *caps):
+        super().__init__(name, *caps)
+        self.writes = 0
+
+    async def set_speed(self, speed):
+        self.writes += 1
+        await sleep(0)
+
+    async def set_pos(self, pos, speed=50, max_power=50):
+        self.writes += 1
+        await sleep(0)
+
+
+class SimulatedVehicle:
+    """
+    Simulated 4x4 off-roader, see `controlminus.model.Vehicle`.
+    """
+    Profiles = [
+        ('normal', 100),
+        ('eco', 60),
+        ('crawl', 30)
+    ]
+
+    # Top speed in degrees per second of motor, maximum steering
+    # angle (in degrees of steering motor) and degrees of heading
+    # change per second at full speed and full lock.
+    top_speed = 1000
+    steering_angle = 90
+    turn_rate = 60
+
+    # Figures for odometry, see `controlminus.model.Vehicle`. Here they
+    # are exact, by definition.
+    TopSpeed = top_speed
+    TurnRate = turn_rate
+
+    def __init__(self, actuators=True):
+        self.peripherals = {}
+        for peripheral in [
+                SimulatedMotor('motor_a', ('sense_speed', 1), ('sense_load', 1), ('sense_power', 1)),
+                SimulatedMotor('motor_b', ('sense_speed', 1), ('sense_load', 1), ('sense_power', 1)),
+                SimulatedMotor('steering', ('sense_pos', 1), ('sense_speed', 1), ('sense_load', 1), ('sense_power', 1)),
+                SimulatedPeripheral('accel', ('sense_grv', 3)),
+                SimulatedPeripheral('gyro', ('sense_rot', 3)),
+                SimulatedPeripheral('position', ('sense_pos', 3)),
+                SimulatedPeripheral('voltage', ('sense_l', 1)),
+                SimulatedPeripheral('current', ('sense_l', 1))]:
+            self.peripherals[peripheral.name] = peripheral
+            setattr(self, peripheral.name, peripheral)
+        self.steering_angle_min = -self.steering_angle
+        self.steering_angle_max = self.steering_angle
+        self.steering_target = 0
+        self.actuators = Actuators() if actuators else None
+        self.time = 0.0
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.battery = 8300.0
+        self._speed = 0
+        self._profile = 0
+        self._handlers = {}
+        self._handler_id = 0
+        self.sensors = SensorStore(self)
+
+    def connect(self, signal, handler, *args):
+        self._handler_id += 1
+        self._handlers[self._handler_id] = (signal, handler, args)
+        return self._handler_id
+
+    def disconnect(self, handler_id):
+        del self._handlers[handler_id]
+
+    def get_property(self, name):
+        if name == 'speed':
+            return self._speed
+        elif name == 'steering':
+            return self.steering_target
+        elif name == 'profile':
+            return self._profile
+        else:
+            raise AttributeError('unknown property %s' % name)
+
+    def set_property(self, name, value):
+        if name == 'speed':
+            self._speed = value
+        elif name == 'steering':
+            self.steering_target = int((value / 100) * self.steering_angle) if abs(value) >= 10 else 0
+        elif name == 'profile':
+            self._profile = value
+        else:
+            raise AttributeError('unknown property %s' % name)
+        prop = SimpleNamespace(name=name)
+        for signal, handler, args in list(self._handlers.values()):
+            if signal == 'notify::' + name:
+                handler(self, prop, *args)
+
+    async def _set_motor_speed(self, motor, speed):
+        if self.actuators != None:
+            await self.actuators.set_speed(motor, speed)
+        else:
+            await motor.set_speed(speed)
+
+    async def set_speed(self, pct):
+        # Writes motors like Vehicle.set_speed() does
+        if abs(pct) < 10:
+            await self._set_motor_speed(self.motor_a, 0)
+            await self._set_motor_speed(self.motor_b, 0)
+        else:
+            limit = self.Profiles[self._profile][1]
+            await self._set_motor_speed(self.motor_a, -1*int(pct * limit / 100))
+            await self._set_motor_speed(self.motor_b, -1*int(pct * limit / 100))
+        self.set_property('speed', pct)
+
+    async def set_steering(self, pct, speed=60):
+        # Writes steering motor like Vehicle.set_steering() does
+        if abs(pct) < 10:
+            pct = 0
+        new_target = int((pct / 100) * self.steering_angle)
+        if new_target != 0 and abs(new_target - self.steering_target) < 5:
+            return
+        self.set_property('steering', pct)
+        if self.actuators != None:
+            await self.actuators.set_pos(self.steering, self.steering_target, speed=50, max_power=100)
+        else:
+            await self.steering.set_pos(self.steering_target, speed=50, max_power=100)
+
+    async def set_profile(self, profile):
+        self.set_property('profile', profile)
+
+    def snapshot(self):
+        return self.sensors.snapshot()
+
+    async def next_snapshot(self, version=None):
+        return await self.sensors.next(version)
+
+    async def halt(self):
+        self.set_property('speed', 0)
+
+    def step(self, dt):
+        """
+        Advance simulation by `dt` seconds and update all sensors.
+        """
+        self.time += dt
+        speed = self._speed if abs(self._speed) >= 10 else 0
+        speed = speed * self.Profiles[self._profile][1] / 100
+
+        # Motors turn at commanded speed (reversed, see Vehicle.set_speed())
+        motor_speed = -int(speed)
+        load = int(abs(speed) / 4)
+        self.motor_a.update(sense_speed=motor_speed, sense_load=load, sense_power=motor_speed)
+        self.motor_b.update(sense_speed=motor_speed, sense_load=load, sense_power=motor_speed)
+
+        # Steering servo moves towards target at ~360 deg/s
+        pos = self.steering.sense_pos
+        delta = max(-360 * dt, min(360 * dt, self.steering_target - pos))
+        self.steering.update(sense_pos=int(pos + delta), sense_speed=int(delta / dt / 10) if dt > 0 else 0, sense_load=0, sense_power=0)
+
+        # Move vehicle
+        lock = self.steering.sense_pos / self.steering_angle
+        turn = self.turn_rate * lock * (speed / 100)
+        self.heading = (self.heading + turn * dt + 180) % 360 - 180
+        distance = (speed / 100) * self.top_speed * dt
+        self.x += distance * cos(radians(self.heading))
+        self.y += distance * sin(radians(self.heading))
+        self.accel.update(sense_grv=[0, 0, 1000])
+        self.gyro.update(sense_rot=[0, 0, int(turn)])
+        self.position.update(sense_pos=[int(self.heading), 0, 0])
+
+        # Battery drains with speed
+        current = 100 + int(abs(speed) * 15)
+        self.battery -= current * dt * 0.0001
+        self.voltage.update(sense_l=int(self.battery))
+        self.current.update(sense_l=current)
+
+    async def run(self, rate=20):
+        """
+        Run simulation in real time, updating sensors `rate` times
+        per second.
+        """
+        while True:
+            self.step(1 / rate)
+            await sleep(1 / rate)
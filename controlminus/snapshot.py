@@ -0,0 +1,218 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Consistent, versioned snapshots of all vehicle's sensor values.
+
+Reading sensor values one at a time (`vehicle.steering.sense_pos`, then
+`vehicle.position.sense_pos`, ...) may mix values from different
+notifications and tells nothing about how fresh they are. `SensorStore`
+keeps latest values of all channels in flat arrays (one slot per
+channel) along with the time each was last updated and a version number
+incremented on every notification. `SensorStore.snapshot()` returns an
+immutable `Snapshot` of all of them at once.
+
+Usage:
+
+    snapshot = vehicle.snapshot()
+    if snapshot.age('steering.sense_pos') < 0.2:
+        angle = snapshot['steering.sense_pos']
+    yaw, pitch, roll = snapshot['position.sense_pos']
+
+    # Wait for next snapshot rather than polling
+    snapshot = await vehicle.next_snapshot(snapshot.version)
+"""
+from array import array
+from asyncio import get_event_loop
+from math import nan
+from time import monotonic
+
+from controlminus.telemetry import peripherals, channels, channel_name, values
+
+
+class Snapshot:
+    """
+    Immutable view of all sensor values at given version. Values are
+    accessed by channel name, like `snapshot['motor_a.sense_speed']` or
+    `snapshot['position.sense_pos.0']`, or by capability name, like
+    `snapshot['position.sense_pos']` which gives a tuple of all its values.
+    """
+    __slots__ = ('version', 'time', 'values', 'times', '_slots')
+
+    def __init__(self, version, time, values, times, slots):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'time', time)
+        object.__setattr__(self, 'values', values)
+        object.__setattr__(self, 'times', times)
+        object.__setattr__(self, '_slots', slots)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("snapshot is immutable")
+
+    def __repr__(self):
+        return 'Snapshot(version=%d, time=%.3f)' % (self.version, self.time)
+
+    def __contains__(self, name):
+        return name in self._slots
+
+    def __getitem__(self, name):
+        slot, n = self._slots[name]
+        if n == 0:
+            return self.values[slot]
+        return self.values[slot:slot + n]
+
+    def get(self, name, default=None):
+        return self[name] if name in self._slots else default
+
+    def names(self):
+        """
+        Return names of all channels (not capabilities).
+        """
+        return [name for name, (slot, n) in self._slots.items() if n == 0]
+
+    def updated(self, name):
+        """
+        Return time (as `time.monotonic()`) given channel (or
+        capability) was last updated, NaN if never.
+        """
+        slot, n = self._slots[name]
+        return self.times[slot]
+
+    def age(self, name, now=None):
+        """
+        Return age (in seconds) of value of given channel (or
+        capability), infinity if never updated.
+        """
+        updated = self.updated(name)
+        if updated != updated:
+            return float('inf')
+        return (monotonic() if now == None else now) - updated
+
+    def stale(self, max_age, now=None):
+        """
+        Return names of channels older than `max_age` seconds.
+        """
+        now = monotonic() if now == None else now
+        return [name for name in self.names() if self.age(name, now) > max_age]
+
+
+class SensorStore:
+    """
+    Keeps latest values of all channels of given vehicle, see module
+    documentation. Not thread-safe, must be used from vehicle's event
+    loop.
+    """
+    def __init__(self, vehicle, clock=monotonic):
+        self.clock = clock
+        self.version = 0
+        self.time = nan
+        self._slots = {}
+        self._offsets = {}
+        n_channels = 0
+        for name, peripheral, cap, base, n in channels(vehicle):
+            self._offsets[(peripheral, cap)] = base
+            if n > 1:
+                self._slots[channel_name(name, cap, 0, 1)] = (base, n)
+            for index in range(n):
+                self._slots[channel_name(name, cap, index, n)] = (base + index, 0)
+            n_channels = base + n
+        self._values = array('d', [nan]) * n_channels
+        self._times = array('d', [nan]) * n_channels
+        self._snapshot = None
+        self._waiters = []
+        for name, peripheral in peripherals(vehicle):
+            self._update(peripheral, nan)
+            peripheral.connect('notify', self.on_peripheral_notify)
+
+    def _update(self, peripheral, now):
+        store = self._values
+        times = self._times
+        for cap in peripheral.capabilities:
+            slot = self._offsets[(peripheral, cap)]
+            for value in values(peripheral, cap):
+                store[slot] = value
+                times[slot] = now
+                slot += 1
+
+    def on_peripheral_notify(self, peripheral):
+        now = self.clock()
+        self._update(peripheral, now)
+        self.version += 1
+        self.time = now
+        self._snapshot = None
+        if self._waiters:
+            snapshot = self.snapshot()
+            waiters = self._waiters
+            self._waiters = []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(snapshot)
+
+    def snapshot(self):
+        """
+        Return snapshot of current values.
+        """
+        if self._snapshot == None:
+            self._snapshot = Snapshot(self.version, self.time, tuple(self._values), tuple(self._times), self._slots)
+        return self._snapshot
+
+    async def next(self, version=None):
+        """
+        Wait for and return a snapshot newer than `version` (or newer than
+        current one if not given).
+        """
+        if version != None and version < self.version:
+            return self.snapshot()
+        waiter = get_event_loop().create_future()
+        self._waiters.append(waiter)
+        return await waiter
+
+
+if __name__ == '__main__':
+    # Measure cost of updating the store and taking snapshots
+    import asyncio
+    from controlminus.simulator import SimulatedVehicle
+
+    vehicle = SimulatedVehicle()
+    store = vehicle.sensors
+    steps = 20000
+    started = monotonic()
+    for i in range(steps):
+        for peripheral in vehicle.peripherals.values():
+            store.on_peripheral_notify(peripheral)
+    updates = monotonic() - started
+    started = monotonic()
+    for i in range(steps):
+        store.on_peripheral_notify(vehicle.motor_a)
+        store.snapshot()
+    snapshots = monotonic() - started
+    print("I: %d channels, %.2f us per notification, notification + snapshot %.2f us" % (len(store.snapshot().names()), updates / steps / len(vehicle.peripherals) * 1e6, snapshots / steps * 1e6))
+
+    async def wait():
+        vehicle.set_property('speed', 50)
+        vehicle.set_property('steering', 30)
+        simulation = asyncio.get_event_loop().create_task(vehicle.run(20))
+        snapshot = store.snapshot()
+        for i in range(3):
+            snapshot = await store.next(snapshot.version)
+            print("I: %s: steering %s, position %s, motor_a age %.3fs" % (snapshot, snapshot['steering.sense_pos'], snapshot['position.sense_pos'], snapshot.age('motor_a.sense_speed')))
+        simulation.cancel()
+
+    asyncio.get_event_loop().run_until_complete(wait())
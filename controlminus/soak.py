@@ -0,0 +1,322 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Soak testing: run the application for a long (simulated) time and watch
+for leaks and drift.
+
+`Soak` runs `VehicleSession`, the very code `VehicleApp` runs for the
+vehicle (connecting and reconnecting, controller handlers, telemetry
+statistics, sensor bus and telemetry view subscriptions, shared memory
+publisher and analytics), just without Gtk UI on top, so it runs where
+Gtk is not available. The real hub is replaced by `StandInHub`, a
+simulated vehicle with the same peripherals streaming sensor values
+(faster than real time), and the gamepad by `SyntheticController`. The
+hub periodically "disconnects" so reconnect code paths are exercised.
+Every few seconds the harness samples
+
+ * resident set size (RSS),
+ * number of objects tracked by garbage collector,
+ * number of live asyncio tasks,
+ * number of rows in telemetry view,
+ * number of signal handlers and bus subscriptions,
+ * worst event loop lag since previous sample,
+
+and at the end reports metrics that keep growing. Usage:
+
+    python3 -m controlminus.soak --hours 2 --speedup 200 --output soak.csv
+
+Exit status is 1 if some leak or drift was detected.
+"""
+import argparse
+import asyncio
+import csv
+import gc
+import os
+import sys
+
+from asyncio import sleep
+from math import sin, cos
+from time import monotonic
+from types import SimpleNamespace
+
+from controlminus.simulator import SimulatedVehicle
+from controlminus.supervisor import Supervisor
+from controlminus.shm import TelemetryPublisher
+from controlminus.session import VehicleSession
+
+
+class StandInHub(SimulatedVehicle):
+    """
+    Simulated vehicle standing in for `controlminus.model.Vehicle`.
+    Property changes are applied in supervised tasks after a simulated
+    BLE round trip, like on the real vehicle.
+    """
+    def __init__(self, latency=0.02):
+        super().__init__()
+        self.latency = latency
+        self.supervisor = Supervisor()
+        for name in ('speed', 'steering', 'profile'):
+            self.supervisor.limit(name, 1)
+
+    def emit(self, signal):
+        for each, handler, args in list(self._handlers.values()):
+            if each == signal:
+                handler(self, *args)
+
+    def set_property(self, name, value):
+        self.supervisor.spawn(self._command(name, value), name)
+
+    async def _command(self, name, value):
+        await sleep(self.latency)
+        super().set_property(name, value)
+
+    async def steering_calibrate(self):
+        await sleep(0.5)
+
+
+class SyntheticController:
+    """
+    Stands in for `Gamepad`, moves sticks along a slow Lissajous curve.
+    """
+    def __init__(self, rate=20):
+        self.rate = rate
+        self.values = { 'abs-l-x' : 128, 'abs-r-y' : 128 }
+        self._handlers = {}
+        self._handler_id = 0
+
+    def connect(self, signal, handler, *args):
+        self._handler_id += 1
+        self._handlers[self._handler_id] = (signal, handler, args)
+        return self._handler_id
+
+    def disconnect(self, handler_id):
+        del self._handlers[handler_id]
+
+    def get_property(self, name):
+        return self.values[name]
+
+    async def dispatch(self):
+        t = 0
+        while True:
+            await sleep(1 / self.rate)
+            t += 1 / self.rate
+            for name, value in (('abs-l-x', 128 + 127 * sin(t / 3)), ('abs-r-y', 128 + 127 * cos(t / 7))):
+                self.values[name] = int(value)
+                prop = SimpleNamespace(name=name)
+                for signal, handler, args in list(self._handlers.values()):
+                    if signal == 'notify::' + name:
+                        handler(self, prop, *args)
+
+
+def rss():
+    """
+    Return resident set size of this process in MB.
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def handlers(vehicle, controller):
+    """
+    Return number of signal handlers connected to given (stand-in)
+    vehicle, its peripherals and controller.
+    """
+    return len(vehicle._handlers) + len(controller._handlers) + \
+        sum(len(peripheral._handlers) for peripheral in vehicle.peripherals.values())
+
+
+METRICS = ['rss', 'objects', 'tasks', 'rows', 'handlers', 'subscriptions', 'lag']
+
+# Metrics (other than RSS and lag) that must not grow at all once
+# the app settles, and tolerated growth of the rest.
+EXACT = ['rows', 'handlers', 'subscriptions']
+TOLERANCE = { 'rss' : 0.10, 'objects' : 0.10, 'tasks' : 5, 'lag' : 2.0 }
+
+
+def drift(samples):
+    """
+    Return list of problems found in given samples. First quarter of
+    samples is considered warm-up and ignored.
+    """
+    if len(samples) < 4:
+        return ["too few samples (%d) to detect drift" % len(samples)]
+    settled = samples[len(samples) // 4:]
+    first = settled[0]
+    last = settled[-1]
+    problems = []
+    for name in EXACT:
+        if last[name] > first[name]:
+            problems.append("%s grew from %d to %d" % (name, first[name], last[name]))
+    for name in ('rss', 'objects'):
+        if last[name] > first[name] * (1 + TOLERANCE[name]):
+            problems.append("%s grew from %.1f to %.1f" % (name, first[name], last[name]))
+    if last['tasks'] > first['tasks'] + TOLERANCE['tasks']:
+        problems.append("tasks grew from %d to %d" % (first['tasks'], last['tasks']))
+    half = len(settled) // 2
+    before = max(sample['lag'] for sample in settled[:half])
+    after = max(sample['lag'] for sample in settled[half:])
+    if after > max(before * TOLERANCE['lag'], 5.0):
+        problems.append("loop lag grew from %.1f ms to %.1f ms" % (before, after))
+    return problems
+
+
+def report(samples):
+    """
+    Return a human readable table of first (after warm-up) and last
+    value of each metric.
+    """
+    settled = samples[len(samples) // 4:]
+    lines = ["%-14s %10s %10s" % ("metric", "settled", "last")]
+    for name in METRICS:
+        lines.append("%-14s %10.1f %10.1f" % (name, settled[0][name], settled[-1][name]))
+    return "\n".join(lines)
+
+
+class Soak(VehicleSession):
+    """
+    Runs `VehicleSession` - the application without UI - against
+    `StandInHub` and `SyntheticController`, see module documentation.
+    """
+    def __init__(self, hours, speedup, interval, reconnect, output=None):
+        VehicleSession.__init__(self)
+        self.hours = hours
+        self.speedup = speedup
+        self.interval = interval
+        self.reconnect = reconnect
+        self.output = output
+        self.simulated = 0.0
+        self.next_reconnect = reconnect
+        self.reconnects = 0
+        self.samples = []
+        self.problems = []
+        self.lag = 0.0
+        self.started = None
+        self.analytics_results = 0
+
+    def create_vehicle(self):
+        return StandInHub()
+
+    def create_controller(self):
+        return SyntheticController()
+
+    async def connect_vehicle(self):
+        self.vehicle.emit('connected')
+        await self.vehicle.steering_calibrate()
+        self.vehicle.emit('initialized')
+
+    async def disconnect_vehicle(self):
+        pass
+
+    def create_publisher(self):
+        # Do not clash with running application
+        return TelemetryPublisher(self.vehicle, 'controlminus-telemetry-soak-%d' % os.getpid(), capacity=4096)
+
+    def on_analytics_result(self, result):
+        VehicleSession.on_analytics_result(self, result)
+        self.analytics_results += 1
+
+    async def simulation_task(self):
+        # Advance simulation by `speedup` times wall clock
+        steps = int(self.speedup * 0.02 / 0.05) or 1
+        while True:
+            await sleep(0.02)
+            for i in range(steps):
+                self.vehicle.step(0.05)
+            self.simulated += steps * 0.05
+            if self.simulated >= self.next_reconnect:
+                self.next_reconnect += self.reconnect
+                self.reconnects += 1
+                self.vehicle.emit('disconnected')
+
+    async def lag_task(self):
+        while True:
+            started = monotonic()
+            await sleep(0.01)
+            self.lag = max(self.lag, monotonic() - started - 0.01)
+
+    def sample(self):
+        gc.collect()
+        sample = {
+            'wall' : monotonic() - self.started,
+            'simulated' : self.simulated,
+            'reconnects' : self.reconnects,
+            'rss' : rss(),
+            'objects' : len(gc.get_objects()),
+            'tasks' : len(asyncio.all_tasks()),
+            'rows' : len(self.telemetry_rows),
+            'handlers' : handlers(self.vehicle, self.controller),
+            'subscriptions' : len(self.bus._subscriptions) if self.bus != None else 0,
+            'lag' : self.lag * 1000,
+        }
+        self.lag = 0.0
+        self.samples.append(sample)
+        print("I: %6.0fs simulated, %d reconnects: %s" % (self.simulated, self.reconnects,
+              ", ".join("%s %.1f" % (name, sample[name]) for name in METRICS)))
+
+    async def soak(self):
+        self.started = monotonic()
+        self.start_session()
+        # Turned on once like by the user, they keep running across
+        # reconnects.
+        self.start_publishing()
+        self.start_analyzing()
+        self.supervisor.spawn(self.simulation_task(), 'soak')
+        self.supervisor.spawn(self.lag_task(), 'soak')
+        while self.simulated < self.hours * 3600:
+            await sleep(self.interval)
+            self.sample()
+        for name in ('soak', 'controller', 'reconnect', 'connect'):
+            await self.supervisor.stop(name)
+        await self.stop_session()
+        self.finish()
+
+    def finish(self):
+        if self.output != None:
+            with open(self.output, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(self.samples[0].keys()))
+                writer.writeheader()
+                writer.writerows(self.samples)
+        self.problems = drift(self.samples)
+        if len(self.samples) >= 4:
+            print("I: %.0fs simulated in %.0fs, %d reconnects, %d analytics batches:\n%s" % (
+                self.simulated, monotonic() - self.started, self.reconnects, self.analytics_results, report(self.samples)))
+        for problem in self.problems:
+            print("W: %s" % problem)
+        if not self.problems:
+            print("I: no leaks or drift detected")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run the application without UI against a simulated hub and watch for leaks")
+    parser.add_argument('--hours', type=float, default=1.0, help="simulated hours to run (default 1)")
+    parser.add_argument('--speedup', type=float, default=200.0, help="simulated seconds per wall second (default 200)")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between samples (default 2)")
+    parser.add_argument('--reconnect', type=float, default=600.0, help="simulated seconds between reconnects (default 600)")
+    parser.add_argument('--output', help="write samples to given CSV file")
+    args = parser.parse_args(argv[1:])
+
+    soak = Soak(args.hours, args.speedup, args.interval, args.reconnect, args.output)
+    asyncio.get_event_loop().run_until_complete(soak.soak())
+    return 1 if soak.problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,98 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Timing of application startup phases.
+
+Startup consists of phases (building UI, connecting to the hub,
+discovering the controller, ...) some of which run concurrently, and
+milestones (window shown, vehicle drivable). `Startup` records when each
+phase started and ended and when each milestone was reached, relative
+to its creation. Usage:
+
+    startup = Startup()
+    with startup.phase('ui'):
+        ...
+    await startup.run('connect', connect())
+    startup.mark('drivable')
+    print(startup.report())
+
+Phases may be recorded from any thread.
+"""
+from contextlib import contextmanager
+from time import monotonic
+
+
+class Startup:
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.phases = {}
+        self.milestones = {}
+
+    def begin(self, name):
+        self.phases[name] = [self.clock() - self.started, None]
+
+    def end(self, name):
+        self.phases[name][1] = self.clock() - self.started
+
+    @contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    async def run(self, name, coro):
+        """
+        Await given coroutine as a phase of given name, return its result.
+        """
+        self.begin(name)
+        try:
+            return await coro
+        finally:
+            self.end(name)
+
+    def mark(self, name):
+        """
+        Record a milestone (only the first time it is reached). Return
+        True if reached for the first time.
+        """
+        if name in self.milestones:
+            return False
+        self.milestones[name] = self.clock() - self.started
+        return True
+
+    def report(self):
+        """
+        Return a human readable timing breakdown, one line per phase
+        and milestone, ordered by time.
+        """
+        lines = []
+        for name, (start, end) in self.phases.items():
+            if end == None:
+                lines.append((start, "%-12s %7.0f ms - (running)" % (name, start * 1000)))
+            else:
+                lines.append((start, "%-12s %7.0f ms - %7.0f ms (%.0f ms)" % (name, start * 1000, end * 1000, (end - start) * 1000)))
+        for name, time in self.milestones.items():
+            lines.append((time, "%-12s %7.0f ms" % (name, time * 1000)))
+        lines.sort(key=lambda line: line[0])
+        return "\n".join(line for time, line in lines)
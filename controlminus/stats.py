@@ -0,0 +1,314 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Constant-memory (online) statistics of vehicle's telemetry and battery
+runtime estimation.
+
+All statistics are updated incrementally as values arrive and keep no
+history, so they can run for arbitrarily long sessions and be queried
+at any time.
+"""
+from sys import float_info
+from math import sqrt, nan
+from time import monotonic
+
+from controlminus.telemetry import peripherals, channels, channel_names, values
+
+
+class P2Quantile:
+    """
+    Streaming estimate of a quantile using the P-square algorithm
+    (Jain & Chlamtac, 1985). Uses five markers regardless of number
+    of values.
+    """
+    def __init__(self, p):
+        self.p = p
+        self._heights = []
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        q = self._heights
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        n = self._positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        desired = self._desired
+        for i in range(5):
+            desired[i] += self._increments[i]
+        for i in (1, 2, 3):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Try parabolic prediction, fall back to linear
+                qp = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                        (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                        (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not (q[i - 1] < qp < q[i + 1]):
+                    qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    @property
+    def value(self):
+        q = self._heights
+        if len(q) == 0:
+            return nan
+        elif len(q) < 5:
+            return q[min(len(q) - 1, int(self.p * len(q)))]
+        return q[2]
+
+
+def _rounded(value, scale):
+    """
+    Return `value` or 0 if it is negligible compared to `scale` (as are
+    values left by EWMA or P-square interpolation of mostly-zero data).
+    """
+    return 0.0 if abs(value) <= scale * 1e-6 else value
+
+
+class RunningStats:
+    """
+    Count, mean, variance (Welford's algorithm), minimum, maximum,
+    exponentially weighted moving average and quantile estimates
+    of a stream of values.
+    """
+    def __init__(self, quantiles=(0.5, 0.9, 0.99), alpha=0.1):
+        self.alpha = alpha
+        self.count = 0
+        self.mean = nan
+        self.min = nan
+        self.max = nan
+        self.ewma = nan
+        self._m2 = 0.0
+        self.quantiles = [ P2Quantile(p) for p in quantiles ]
+
+    def add(self, x):
+        if x != x:
+            return
+        self.count += 1
+        if self.count == 1:
+            self.mean = self.min = self.max = self.ewma = x
+        else:
+            delta = x - self.mean
+            self.mean += delta / self.count
+            self._m2 += delta * (x - self.mean)
+            if x < self.min:
+                self.min = x
+            elif x > self.max:
+                self.max = x
+            self.ewma += self.alpha * (x - self.ewma)
+            if abs(self.ewma) < float_info.min:
+                # Decaying towards 0 would otherwise get stuck in
+                # (slow) denormals.
+                self.ewma = 0.0
+        for quantile in self.quantiles:
+            quantile.add(x)
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else nan
+
+    @property
+    def stddev(self):
+        return sqrt(self.variance) if self.count > 1 else nan
+
+    def quantile(self, p):
+        for quantile in self.quantiles:
+            if quantile.p == p:
+                return quantile.value
+        raise ValueError("quantile %s not tracked" % p)
+
+    def summary(self):
+        """
+        Return all statistics as a dictionary. Estimates negligible
+        compared to the range of values are reported as 0.
+        """
+        scale = max(abs(self.min), abs(self.max)) if self.count > 0 else 0.0
+        result = {
+            'count' : self.count,
+            'mean' : _rounded(self.mean, scale),
+            'stddev' : _rounded(self.stddev, scale),
+            'min' : self.min,
+            'max' : self.max,
+            'ewma' : _rounded(self.ewma, scale),
+        }
+        for quantile in self.quantiles:
+            result['p%g' % (quantile.p * 100)] = _rounded(quantile.value, scale)
+        return result
+
+
+class BatteryEstimator:
+    """
+    Estimates energy used and remaining runtime from hub's voltage
+    (in mV) and current (in mA) readings. Note that these must be
+    millivolts, not the raw reading of some hubs' voltage sensor
+    (0-3893, see bricknil's `VoltageSensor`): voltages outside of
+    `empty_voltage * 0.75` to `full_voltage * 1.5` are reported and not
+    used to estimate the initial charge.
+
+    Initial state of charge is estimated from the voltage (linearly
+    between `empty_voltage` and `full_voltage`), then charge is counted
+    by integrating current. Remaining runtime assumes current stays at
+    its (exponentially weighted) average.
+
+    Defaults correspond to six AA alkaline cells of Control+ hub.
+    """
+    capacity = 2000.0       # mAh
+    full_voltage = 9000.0   # mV
+    empty_voltage = 6000.0  # mV
+
+    def __init__(self, alpha=0.01):
+        self.voltage = nan
+        self.current = RunningStats(quantiles=(), alpha=alpha)
+        self.energy = 0.0   # Wh
+        self.charge = 0.0   # mAh
+        self.initial_charge = nan
+        self._time = None
+        self._last = 0.0
+        self._warned = False
+
+    def add_voltage(self, mv):
+        if not (self.empty_voltage * 0.75 <= mv <= self.full_voltage * 1.5):
+            if not self._warned:
+                print("W: battery voltage %s out of range, expected millivolts" % mv)
+                self._warned = True
+            return
+        self.voltage = mv
+        if self.initial_charge != self.initial_charge:
+            fraction = (mv - self.empty_voltage) / (self.full_voltage - self.empty_voltage)
+            self.initial_charge = self.capacity * max(0.0, min(1.0, fraction))
+
+    def add_current(self, ma, now):
+        if self._time != None and self.current.count > 0:
+            # Integrate with the previous value (rectangle rule)
+            hours = (now - self._time) / 3600
+            self.charge += self._last * hours
+            if self.voltage == self.voltage:
+                self.energy += (self.voltage / 1000) * (self._last / 1000) * hours
+        self._time = now
+        self._last = ma
+        self.current.add(ma)
+
+    @property
+    def remaining_charge(self):
+        """
+        Estimated remaining charge in mAh
+        """
+        return max(0.0, self.initial_charge - self.charge)
+
+    @property
+    def remaining_fraction(self):
+        return self.remaining_charge / self.capacity
+
+    @property
+    def remaining_runtime(self):
+        """
+        Estimated remaining runtime in seconds (NaN if unknown).
+        """
+        if self.current.count == 0 or self.current.ewma <= 0 or self.initial_charge != self.initial_charge:
+            return nan
+        return self.remaining_charge / self.current.ewma * 3600
+
+
+class TelemetryStats:
+    """
+    Keeps `RunningStats` for each channel of given vehicle, motor command
+    (BLE write) latency and a `BatteryEstimator`. Usage:
+
+        stats = TelemetryStats(vehicle)
+        ...
+        print(stats.summary())
+        print(stats.battery.remaining_runtime)
+
+    `clock` returns current time in seconds, it defaults to `time.monotonic`.
+    """
+    def __init__(self, vehicle, clock=monotonic):
+        self.vehicle = vehicle
+        self.clock = clock
+        self.channels = {}
+        self.battery = BatteryEstimator()
+        self._stats = {}
+        names = channel_names(vehicle)
+        for name, peripheral, cap, base, n in channels(vehicle):
+            stats = [ RunningStats() for index in range(n) ]
+            self._stats[(peripheral, cap)] = stats
+            for index in range(n):
+                self.channels[names[base + index]] = stats[index]
+        for name, peripheral in peripherals(vehicle):
+            peripheral.connect('notify', self.on_peripheral_notify)
+        self._voltage = vehicle.peripherals.get('voltage')
+        self._current = vehicle.peripherals.get('current')
+
+    @property
+    def command_latency(self):
+        """
+        Latency of motor commands (in seconds) as `RunningStats`.
+        """
+        return self.vehicle.actuators.latency
+
+    def on_peripheral_notify(self, peripheral):
+        for cap in peripheral.capabilities:
+            for stats, value in zip(self._stats[(peripheral, cap)], values(peripheral, cap)):
+                stats.add(value)
+        if peripheral == self._voltage:
+            self.battery.add_voltage(values(peripheral, peripheral.capabilities[0])[0])
+        elif peripheral == self._current:
+            self.battery.add_current(values(peripheral, peripheral.capabilities[0])[0], self.clock())
+
+    def summary(self):
+        """
+        Return a dictionary of channel names to dictionaries with
+        statistics, see `RunningStats.summary()`.
+        """
+        result = { name : stats.summary() for name, stats in self.channels.items() }
+        result['command.latency'] = self.command_latency.summary()
+        return result
+
+
+if __name__ == '__main__':
+    # Run simulated vehicle for an hour of simulated time and print
+    # statistics.
+    from controlminus.simulator import SimulatedVehicle
+
+    vehicle = SimulatedVehicle()
+    stats = TelemetryStats(vehicle, lambda: vehicle.time)
+    vehicle.set_property('speed', 60)
+    vehicle.set_property('steering', 40)
+    for i in range(3600 * 20):
+        vehicle.step(0.05)
+    for name, summary in stats.summary().items():
+        print("%-24s %s" % (name, ' '.join('%s=%.4g' % each for each in summary.items())))
+    print("I: energy used %.2f Wh, remaining %.0f%%, runtime %.1f h" % (stats.battery.energy, stats.battery.remaining_fraction * 100, stats.battery.remaining_runtime / 3600))
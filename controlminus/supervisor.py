@@ -0,0 +1,269 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Supervision of asyncio tasks.
+
+All tasks working with the vehicle are started through a `Supervisor`
+rather than with bare `asyncio.create_task()` so that:
+
+ * exceptions are reported rather than silently lost,
+ * number of concurrently running tasks of each category can be limited
+   (for example, at most one `set_steering()` at a time),
+ * run time and failures of tasks are recorded,
+ * whole categories (subsystems) can be cancelled and restarted,
+ * number of live tasks is known at any time.
+
+Usage:
+
+    supervisor = Supervisor()
+    supervisor.limit('steering', 1)
+    supervisor.spawn(vehicle.set_steering(50), 'steering')
+    ...
+    supervisor.restart('connect', connect_task)
+    print(supervisor.counts())
+"""
+import sys
+import traceback
+
+from asyncio import create_task, get_event_loop, CancelledError
+from time import monotonic
+
+from controlminus.stats import RunningStats
+
+
+class Category:
+    """
+    Tasks of one category along with their statistics. If number of
+    running tasks reaches `limit`, only the most recently spawned
+    coroutine is kept pending (and started once a running task
+    finishes), older pending ones are dropped. This suits commands
+    where only the latest one matters.
+    """
+    def __init__(self, name, limit=None):
+        self.name = name
+        self.limit = limit
+        self.tasks = set()
+        self.pending = None
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.last_error = None
+        self.latency = RunningStats()
+
+    def summary(self):
+        """
+        Return statistics as a dictionary.
+        """
+        return {
+            'live' : len(self.tasks),
+            'pending' : 1 if self.pending != None else 0,
+            'started' : self.started,
+            'completed' : self.completed,
+            'failed' : self.failed,
+            'cancelled' : self.cancelled,
+            'dropped' : self.dropped,
+            'latency' : self.latency.summary(),
+        }
+
+
+class Supervisor:
+    """
+    Spawns and keeps track of tasks, see module documentation. If
+    `max_live` is given, a warning is printed whenever number of live
+    tasks exceeds it - number of tasks should stay small, growing number
+    means they are spawned faster than they complete.
+    """
+    def __init__(self, clock=monotonic, max_live=None):
+        self.clock = clock
+        self.max_live = max_live
+        self.categories = {}
+        self._over = False
+
+    def category(self, name):
+        """
+        Return `Category` of given name, creating it if needed.
+        """
+        category = self.categories.get(name)
+        if category == None:
+            category = self.categories[name] = Category(name)
+        return category
+
+    def limit(self, name, limit):
+        """
+        Limit number of concurrently running tasks of given category
+        (None for no limit).
+        """
+        self.category(name).limit = limit
+
+    def spawn(self, coro, category='default'):
+        """
+        Start a task running given coroutine in given category. Return
+        the task or None if category is at its limit and the coroutine
+        was queued.
+        """
+        category = self.category(category)
+        if category.limit != None and len(category.tasks) >= category.limit:
+            if category.pending != None:
+                category.pending.close()
+                category.dropped += 1
+            category.pending = coro
+            return None
+        return self._start(category, coro)
+
+    def _start(self, category, coro):
+        task = create_task(coro)
+        category.tasks.add(task)
+        category.started += 1
+        started = self.clock()
+        task.add_done_callback(lambda task: self._done(category, task, started))
+        if self.max_live != None and not self._over:
+            live = self.live()
+            if live > self.max_live:
+                self._over = True
+                print("W: %d live tasks: %s" % (live, self.counts()))
+        return task
+
+    def _done(self, category, task, started):
+        category.tasks.discard(task)
+        if self._over and self.live() <= self.max_live:
+            self._over = False
+        category.latency.add(self.clock() - started)
+        if task.cancelled():
+            category.cancelled += 1
+        elif task.exception() != None:
+            category.failed += 1
+            category.last_error = task.exception()
+            self.report(category.name, task.exception())
+        else:
+            category.completed += 1
+        if category.pending != None and (category.limit == None or len(category.tasks) < category.limit):
+            coro = category.pending
+            category.pending = None
+            self._start(category, coro)
+
+    def report(self, name, exception):
+        print("E: task in %s failed: %s" % (name, exception), file=sys.stderr)
+        traceback.print_exception(type(exception), exception, exception.__traceback__)
+
+    def cancel(self, name):
+        """
+        Cancel all tasks of given category (including pending one).
+        Return list of cancelled tasks.
+        """
+        category = self.category(name)
+        if category.pending != None:
+            category.pending.close()
+            category.pending = None
+            category.dropped += 1
+        tasks = list(category.tasks)
+        for task in tasks:
+            task.cancel()
+        return tasks
+
+    async def stop(self, name):
+        """
+        Cancel all tasks of given category and wait for them to finish.
+        """
+        for task in self.cancel(name):
+            try:
+                await task
+            except CancelledError:
+                pass
+            except Exception:
+                # Already reported
+                pass
+
+    async def restart(self, name, factory):
+        """
+        Stop all tasks of given category and then spawn `factory()`
+        in it.
+        """
+        await self.stop(name)
+        return self.spawn(factory(), name)
+
+    def counts(self):
+        """
+        Return dictionary of category names to number of live tasks.
+        """
+        return { name : len(category.tasks) for name, category in list(self.categories.items()) }
+
+    def live(self):
+        """
+        Return total number of live tasks. May be called from other
+        threads.
+        """
+        return sum(len(category.tasks) for category in list(self.categories.values()))
+
+    def summary(self):
+        return { name : category.summary() for name, category in self.categories.items() }
+
+    def exception_handler(self, loop, context):
+        """
+        Event loop exception handler, see `install()`.
+        """
+        exception = context.get('exception')
+        if exception != None:
+            self.report('event loop (%s)' % context.get('message'), exception)
+        else:
+            loop.default_exception_handler(context)
+
+    def install(self, loop=None):
+        """
+        Report exceptions not handled elsewhere in given (or current)
+        event loop.
+        """
+        (loop or get_event_loop()).set_exception_handler(self.exception_handler)
+
+
+if __name__ == '__main__':
+    # Flood supervisor with steering commands as UI input would and
+    # show how many tasks actually ran.
+    import asyncio
+    from controlminus.simulator import SimulatedVehicle
+
+    async def main():
+        vehicle = SimulatedVehicle()
+        supervisor = Supervisor()
+        supervisor.limit('steering', 1)
+
+        async def slow_steering(pct):
+            # Simulate BLE round trip
+            await asyncio.sleep(0.02)
+            await vehicle.set_steering(pct)
+
+        async def failing():
+            raise ValueError("broken")
+
+        peak = 0
+        for i in range(1000):
+            supervisor.spawn(slow_steering(i % 200 - 100), 'steering')
+            peak = max(peak, supervisor.live())
+            await asyncio.sleep(0.001)
+        supervisor.spawn(failing(), 'misc')
+        await asyncio.sleep(0.1)
+        steering = supervisor.category('steering')
+        print("I: 1000 commands: %d started, %d dropped, peak %d live tasks, mean latency %.1f ms" % (
+            steering.started, steering.dropped, peak, steering.latency.mean * 1000))
+        print("I: misc: %d failed (%r)" % (supervisor.category('misc').failed, supervisor.category('misc').last_error))
+
+    asyncio.run(main())
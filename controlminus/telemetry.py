@@ -0,0 +1,104 @@
+# Copyright (c) 2020 Jan Vrany <jan.vrany (a) fit.cvut.cz>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Helpers to enumerate and read vehicle's sensor values (telemetry)
+in an uniform way.
+
+Each capability of each peripheral reports one or more values (datasets),
+for example `sense_speed` of a motor reports a single value while
+`sense_pos` of hub's IMU reports three (yaw, pitch and roll). Here, each
+such value is called a "channel" and is identified by a tuple
+(peripheral name, capability name, index).
+"""
+from math import nan
+
+
+def datasets(peripheral, cap):
+    """
+    Return number of values given capability of given peripheral
+    reports.
+    """
+    try:
+        return peripheral.datasets[cap][0]
+    except (AttributeError, KeyError, IndexError, TypeError):
+        value = peripheral.value[cap] if peripheral.value else None
+        return len(value) if isinstance(value, (list, tuple)) else 1
+
+
+def peripherals(vehicle):
+    """
+    Return a list of (name, peripheral) tuples of all vehicle's peripherals
+    that report some values, sorted by name (so the order is stable from
+    run to run).
+    """
+    return sorted([(name, peripheral) for name, peripheral in vehicle.peripherals.items() if len(peripheral.capabilities) > 0], key=lambda each: each[0])
+
+
+def channels(vehicle):
+    """
+    Return a list of (peripheral name, peripheral, capability, base index,
+    number of datasets) tuples, one for each capability of the vehicle.
+    Channels are numbered consecutively in this order, values of a
+    capability are channels `base index` .. `base index + number of
+    datasets - 1`.
+    """
+    result = []
+    base = 0
+    for name, peripheral in peripherals(vehicle):
+        for cap in peripheral.capabilities:
+            n = datasets(peripheral, cap)
+            result.append((name, peripheral, cap, base, n))
+            base += n
+    return result
+
+
+def channel_names(vehicle):
+    """
+    Return a list of names of all channels of the vehicle, indexed
+    by channel number (see `channels()`).
+    """
+    return [channel_name(name, cap, index, n) for name, peripheral, cap, base, n in channels(vehicle) for index in range(n)]
+
+
+def channel_name(peripheral_name, cap, index, n_datasets = 1):
+    """
+    Return a (human readable) name of given channel, like
+    `motor_a.sense_speed` or `position.sense_pos.0`.
+    """
+    cap_name = cap if isinstance(cap, str) else cap.name
+    if n_datasets == 1:
+        return "%s.%s" % (peripheral_name, cap_name)
+    else:
+        return "%s.%s.%d" % (peripheral_name, cap_name, index)
+
+
+def values(peripheral, cap):
+    """
+    Return current value(s) of given capability as a tuple of floats.
+    Values not (yet) reported by the hub are NaN.
+    """
+    value = peripheral.value[cap] if peripheral.value else None
+    if isinstance(value, (list, tuple)):
+        return tuple(nan if each is None else float(each) for each in value)
+    elif value is None:
+        return (nan, ) * datasets(peripheral, cap)
+    else:
+        return (float(value), )
@@ -20,14 +20,130 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import os
+import ctypes
+import struct
+
+from asyncio import Queue, get_event_loop, sleep
+from fnmatch import fnmatch
 from bricknil.process import Process
-from evdev import InputDevice, events, ecodes, list_devices
+from evdev import InputDevice, ecodes, list_devices
 
 
-class DualShock3(Process):
+class Mapping:
     """
-    This class implements interface to Sony Playstation 3
-    Dual Shock controller
+    Describes how to map events of a gamepad to properties. `name` is
+    a (glob) pattern matching device name, None matches any gamepad.
+    `axes` maps absolute axis codes to property names, `buttons` maps
+    (device-specific) button codes to (standard) codes used in
+    button-press-event and button-release-event.
+    """
+    def __init__(self, name, axes, buttons={}):
+        self.name = name
+        self.axes = axes
+        self.buttons = buttons
+
+    def matches(self, device):
+        caps = device.capabilities(absinfo=False)
+        if not all(code in caps.get(ecodes.EV_ABS, []) for code in self.axes):
+            return False
+        if self.name != None:
+            return fnmatch(device.name, self.name)
+        else:
+            return ecodes.BTN_GAMEPAD in caps.get(ecodes.EV_KEY, [])
+
+STANDARD_AXES = {
+    ecodes.ABS_X : 'abs-l-x',
+    ecodes.ABS_Y : 'abs-l-y',
+    ecodes.ABS_RX : 'abs-r-x',
+    ecodes.ABS_RY : 'abs-r-y',
+}
+
+# Older (DirectInput-style) gamepads report right thumbstick as Z / RZ.
+DIRECTINPUT_AXES = {
+    ecodes.ABS_X : 'abs-l-x',
+    ecodes.ABS_Y : 'abs-l-y',
+    ecodes.ABS_Z : 'abs-r-x',
+    ecodes.ABS_RZ : 'abs-r-y',
+}
+
+PS3 = 'Sony PLAYSTATION(R)3 Controller'
+
+# Mappings are tried in order, first one matching is used. Both hid-sony
+# and hid-playstation report right thumbstick of DualShock 4 as RX / RY
+# (Z / RZ are triggers). It is called just 'Wireless Controller' when
+# paired over Bluetooth.
+MAPPINGS = [
+    Mapping(PS3, STANDARD_AXES),
+    Mapping('Sony Computer Entertainment Wireless Controller', STANDARD_AXES),
+    Mapping('Sony Interactive Entertainment Wireless Controller', STANDARD_AXES),
+    Mapping('Wireless Controller', STANDARD_AXES),
+    Mapping('Logitech Logitech Dual Action', DIRECTINPUT_AXES),
+    Mapping('Logitech Dual Action', DIRECTINPUT_AXES),
+    Mapping(None, STANDARD_AXES),
+]
+
+
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class DeviceMonitor:
+    """
+    Watches a directory (like /dev/input) for new or changed device nodes
+    using inotify, so new devices are noticed immediately, without polling.
+    """
+    def __init__(self, path='/dev/input'):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+        if self._libc.inotify_add_watch(self._fd, os.fsencode(path), IN_CREATE | IN_ATTRIB | IN_DELETE) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, "inotify_add_watch() failed for %s" % path)
+        self._path = path
+        self._changes = Queue()
+        get_event_loop().add_reader(self._fd, self._on_readable)
+
+    def close(self):
+        get_event_loop().remove_reader(self._fd)
+        os.close(self._fd)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            self._changes.put_nowait((mask, os.path.join(self._path, name)))
+
+    async def changed(self):
+        """
+        Wait for a change, return (mask, path) tuple.
+        """
+        return await self._changes.get()
+
+
+class Gamepad(Process):
+    """
+    This class implements interface to (any) evdev gamepad. Gamepads are
+    recognized and their events are translated using `MAPPINGS`. Gamepad
+    does not need to be connected at the time this object is created,
+    it is picked up as soon as it appears (and also when it reconnects).
+
+    Thumbstick values are normalized to range <0,255>. When gamepad
+    disconnects, thumbsticks are reset to center.
+
+    New devices are noticed using `DeviceMonitor`. If the device directory
+    cannot be watched, it is rescanned every `rescan_interval` seconds
+    instead.
     """
 
     _properties_ = [
@@ -42,23 +158,29 @@ class DualShock3(Process):
         'button-release-event'
     ]
 
-    def __init__(self, evdevice = None):
-        if evdevice == None:
-            devices = [InputDevice(fn) for fn in list_devices()]
-            for device in devices:
-                if device.name == 'Sony PLAYSTATION(R)3 Controller':
-                    evdevice = device.path
-            if evdevice == None:
-                raise Exception("No PS3 DualShock controller detected")
-        super().__init__(evdevice)
+    # Ignore changes smaller than this (in range <0,255>)
+    threshold = 2
 
-        self.__dev = InputDevice(evdevice)
+    rescan_interval = 1.0
+
+    def __init__(self, evdevice = None, mappings = MAPPINGS, path = '/dev/input'):
+        super().__init__("gamepad")
+        self._evdevice = evdevice
+        self._mappings = mappings
+        self._path = path
+        self.device = None
+        self.mapping = None
+        self._axes = {}
 
         self.__abs_l_x = 128
         self.__abs_l_y = 128
         self.__abs_r_x = 128
         self.__abs_r_y = 128
 
+    @property
+    def connected(self):
+        return self.device != None
+
     def do_get_property(self, prop):
         if prop.name == 'abs-l-x':
             return self.__abs_l_x
@@ -83,26 +205,114 @@ class DualShock3(Process):
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
+    def _open(self, path):
+        """
+        Open device at given path if it is a (supported) gamepad. Return
+        True if so, False otherwise.
+        """
+        if self._evdevice != None and path != self._evdevice:
+            return False
+        try:
+            device = InputDevice(path)
+        except OSError:
+            # Not (yet) accessible, we will be notified (IN_ATTRIB)
+            # once permissions are set.
+            return False
+        for mapping in self._mappings:
+            if mapping.matches(device):
+                self.device = device
+                self.mapping = mapping
+                # Precompute scaling of each axis to <0,255>
+                self._axes = {}
+                for code, prop in mapping.axes.items():
+                    info = device.absinfo(code)
+                    self._axes[code] = (prop, info.min, max(1, info.max - info.min))
+                self.message_info("using %s (%s)" % (device.name, path))
+                return True
+        device.close()
+        return False
+
+    def _close(self):
+        self.message_info("%s disconnected" % self.device.name)
+        try:
+            self.device.close()
+        except OSError:
+            pass
+        self.device = None
+        self.mapping = None
+        # Reset thumbsticks so whatever they control stops
+        for prop in self._properties_:
+            if self.get_property(prop) != 128:
+                self.set_property(prop, 128)
+
+    def _scan(self):
+        """
+        Open first supported gamepad found. Return True if there's one,
+        False otherwise.
+        """
+        for path in list_devices(self._path):
+            if self._open(path):
+                return True
+        return False
+
     async def dispatch(self):
-        async for ev in self.__dev.async_read_loop():
-            if ev.type == events.EV_ABS:
-                if ev.code == ecodes.ABS_X:
-                    if abs(self.__abs_l_x - ev.value) > 2:
-                        self.set_property('abs-l-x', ev.value)
-                elif ev.code == ecodes.ABS_Y:
-                    if abs(self.__abs_l_y - ev.value) > 2:
-                        self.set_property('abs-l-y', ev.value)
-                elif ev.code == ecodes.ABS_RX:
-                    if abs(self.__abs_r_x - ev.value) > 2:
-                        self.set_property('abs-r-x', ev.value)
-                elif ev.code == ecodes.ABS_RY:
-                    if abs(self.__abs_r_y - ev.value) > 2:
-                        self.set_property('abs-r-y', ev.value)
-            elif ev.type == events.EV_KEY:
+        # Start watching before scanning so no device is missed.
+        try:
+            monitor = DeviceMonitor(self._path)
+        except (OSError, AttributeError) as e:
+            self.message_info("cannot watch %s (%s), rescanning every %gs" % (self._path, e, self.rescan_interval))
+            monitor = None
+        try:
+            while True:
+                # Scan after each disconnect too, another gamepad may have
+                # been connected meanwhile (or the same one reconnected
+                # while the old device was still open).
+                self._scan()
+                while self.device == None:
+                    if monitor != None:
+                        mask, path = await monitor.changed()
+                        if not (mask & IN_DELETE) and os.path.basename(path).startswith('event'):
+                            self._open(path)
+                    else:
+                        await sleep(self.rescan_interval)
+                        self._scan()
+                try:
+                    await self._read()
+                except OSError:
+                    # Device disconnected
+                    pass
+                self._close()
+        finally:
+            if monitor != None:
+                monitor.close()
+
+    async def _read(self):
+        axes = self._axes
+        buttons = self.mapping.buttons
+        threshold = self.threshold
+        async for ev in self.device.async_read_loop():
+            if ev.type == ecodes.EV_ABS:
+                axis = axes.get(ev.code)
+                if axis != None:
+                    prop, lo, span = axis
+                    value = ((ev.value - lo) * 255) // span
+                    if abs(self.get_property(prop) - value) > threshold:
+                        self.set_property(prop, value)
+            elif ev.type == ecodes.EV_KEY:
+                code = buttons.get(ev.code, ev.code)
                 if ev.value == 1:
-                    await self.emit('button-press-event', ev.code)
-                else:
-                    await self.emit('button-release-event', ev.code)
+                    await self.emit('button-press-event', code)
+                elif ev.value == 0:
+                    await self.emit('button-release-event', code)
+
+
+class DualShock3(Gamepad):
+    """
+    This class implements interface to Sony Playstation 3
+    Dual Shock controller
+    """
+    def __init__(self, evdevice = None):
+        super().__init__(evdevice, [mapping for mapping in MAPPINGS if mapping.name == PS3])
 
 if __name__ == '__main__':
     import asyncio
@@ -125,7 +335,7 @@ if __name__ == '__main__':
         seq += 1
 
 
-    controller = DualShock3()
+    controller = Gamepad()
     controller.connect("notify::abs-l-x", on_xy_change)
     controller.connect("notify::abs-l-y", on_xy_change)
     controller.connect("notify::abs-r-x", on_xy_change)
@@ -21,47 +21,119 @@
 import gi
 gi.require_version("Gtk", "3.0")
 
-from asyncio import sleep, get_event_loop, set_event_loop_policy, run_coroutine_threadsafe, create_task as spawn
+from asyncio import sleep, get_event_loop, set_event_loop_policy, run_coroutine_threadsafe
 
 import os
+import signal
+import threading
+import time
 import bricknil
 
 from gi.repository import GObject, Gtk, Gdk, Gio, GLib
 
 from controlminus import GTKEventLoopPolicy, GLibEventLoop
 from controlminus.model import Vehicle
-from controlminus.ui.widget import Joystick, TiltIndicator, BearingIndicator
-from controlminus.ui.controller import DualShock3
+from controlminus.ui.widget import Joystick, TiltIndicator, BearingIndicator, StripChart
+from controlminus.ui.controller import Gamepad
+from controlminus.remote import HOST
+from controlminus.control import ControlThread, StateChannel
+from controlminus.telemetry import datasets, values
+from controlminus.startup import Startup
+from controlminus.profiler import SamplingProfiler
+from controlminus.session import VehicleSession
 
-def scale(val, src, dst):
-    """
-    Scale the given value from the scale of src to the scale of dst.
 
-    val: float or int
-    src: tuple
-    dst: tuple
-
-    example: print(scale(99, (0.0, 99.0), (-1.0, +1.0)))
-    """
-    return round((float(val - src[0]) / (src[1] - src[0])) * (dst[1] - dst[0]) + dst[0])
-
-class VehicleApp(Gtk.Application):
+class VehicleApp(Gtk.Application, VehicleSession):
     def __init__(self):
         Gtk.Application.__init__(self, application_id="org.controlminus.vehicle",flags=Gio.ApplicationFlags.FLAGS_NONE)
-        self.vehicle = None
+        VehicleSession.__init__(self)
+        self.add_main_option("threaded", ord("t"), GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
+                             "Run vehicle control in a dedicated thread", None)
+        self.add_main_option("profile", ord("p"), GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
+                             "Start sampling profiler right away (toggle with SIGUSR1)", None)
+        self.add_main_option("remote-host", ord("r"), GLib.OptionFlags.NONE, GLib.OptionArg.STRING,
+                             "Address remote control server listens on (default %s, loopback only)" % HOST, "HOST")
+        self.threaded = False
+        self.profile = False
+        self.profiler = None
         self.vehicle_loop = None
+        self.builder = None
+        self.keypad_connected = False
+
+    def do_handle_local_options(self, options):
+        self.threaded = options.contains("threaded")
+        self.profile = options.contains("profile")
+        if options.contains("remote-host"):
+            self.remote_host = options.lookup_value("remote-host").get_string()
+        return -1
 
     def do_startup(self):
         Gtk.Application.do_startup(self)
 
+        # Connecting to the hub (BLE scan and hub initialization) and
+        # controller discovery run in vehicle loop independently of UI,
+        # so start them first and build the UI meanwhile. In threaded
+        # mode they run in control thread, otherwise they are run up to
+        # their first I/O before building the UI so that the scan is
+        # already going on (in bluetoothd) while UI is being built.
+        self.startup = Startup()
+        with self.startup.phase('loop'):
+            # Setup asyncio event loop:
+            set_event_loop_policy(GTKEventLoopPolicy())
+            self.vehicle_loop = get_event_loop()
+            self.vehicle_loop.be_running()
+
+            # In threaded mode, vehicle (and controller) lives in control
+            # thread with its own event loop. UI sends commands there and
+            # receives sensor updates back through (coalescing) state channels
+            # so neither blocks the other.
+            if self.threaded:
+                self.control = ControlThread()
+                self.control.start()
+                self.vehicle_loop = self.control.loop
+                self.commands = StateChannel(self.control.call, self.on_commands)
+                self.sensors = StateChannel(GLib.idle_add, self.on_sensors)
+
+        self.start_session()
+        if self.control == None:
+            context = GLib.MainContext.default()
+            for i in range(100):
+                if not context.iteration(False):
+                    break
+
+        with self.startup.phase('ui'):
+            self.setup_ui()
+
+        GLib.timeout_add_seconds(1, self.on_battery_timer)
+
+    def setup_ui(self):
         action = Gio.SimpleAction.new("calibrate", None)
         action.connect("activate", self.on_calibrate)
         self.add_action(action)
 
-        action = Gio.SimpleAction.new("debug", None)
-        action.connect("activate", self.on_debug)
+        action = Gio.SimpleAction.new_stateful("record", None, GLib.Variant.new_boolean(False))
+        action.connect("change-state", self.on_record)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new_stateful("remote", None, GLib.Variant.new_boolean(False))
+        action.connect("change-state", self.on_remote)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new_stateful("publish", None, GLib.Variant.new_boolean(False))
+        action.connect("change-state", self.on_publish)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new_stateful("analyze", None, GLib.Variant.new_boolean(False))
+        action.connect("change-state", self.on_analyze)
         self.add_action(action)
 
+        action = Gio.SimpleAction.new_stateful("profile", None, GLib.Variant.new_boolean(False))
+        action.connect("change-state", self.on_profile)
+        self.add_action(action)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self.on_profile_signal)
+        if self.profile:
+            self.change_action_state("profile", GLib.Variant.new_boolean(True))
+
         action = Gio.SimpleAction.new("quit", None)
         action.connect("activate", self.on_quit)
         self.add_action(action)
@@ -104,142 +176,216 @@ class VehicleApp(Gtk.Application):
         self.roll.set_vexpand(True)
         self.builder.get_object("dashboard-box").add(self.roll)
 
+        self.chart = StripChart()
+        self.chart.set_hexpand(True)
+        self.builder.get_object("chart-box").add(self.chart)
+        self.chart_channel = None
+        self.chart_subscription = None
+        self.telemetry_store_channels = {}
+
         telemetry = self.builder.get_object("telemetry")
         telemetry.append_column(Gtk.TreeViewColumn("Sensor", Gtk.CellRendererText(), text=0))
         telemetry.append_column(Gtk.TreeViewColumn("Value", Gtk.CellRendererText(), text=1))
+        telemetry.get_selection().connect("changed", self.on_telemetry_selection_changed)
         self.telemetry_store  =Gtk.TreeStore(str, str)
         telemetry.set_model(self.telemetry_store)
 
-        # Setup asyncio event loop:
-        set_event_loop_policy(GTKEventLoopPolicy())
-        self.vehicle_loop = get_event_loop()
-        self.vehicle_loop.be_running()
-
-        def exception_handler(context):
-        	breakpoint()
-
-        # Setup model
-        self.vehicle = Vehicle()
-        self.vehicle.connect('connected', self.on_connected)
-        self.vehicle.connect('initialized', self.on_initialized)
-        self.vehicle.connect('disconnected', self.on_disconnected)
-
-
-        # Setup controller (remote)
-        self.controller = None
-        try:
-            self.controller = controller = DualShock3()
-            spawn(controller.dispatch())
-        except:
-            # No controller (remote) available
-            pass
-
-        # async def setup():
-        #     initialized = False
-        #     while not initialized:
-        #         try:
-        #             self.builder.get_object("content").set_visible_child(self.builder.get_object("connecting"))
-        #             await bricknil.initialize()
-        #             initialized = True
-        #         except Exception as ex:
-        #             if str(ex) == "Bluetooth adapter not found":
-        #                 self.builder.get_object("content").set_visible_child(self.builder.get_object("nobtdevice"))
-        #                 await sleep(1)
-        #             else:
-        #                 raise ex
-
-        #     for name, peripheral in self.vehicle.peripherals.items():
-        #         peripheral.connect('notify', self.on_vehicle_sensor_reading_changed)
-        spawn(self.connect_task())
-
-    async def connect_task(self):
-        self.builder.get_object("content").set_visible_child(self.builder.get_object("connecting"))
+    def create_vehicle(self):
+        return Vehicle()
+
+    def create_controller(self):
+        return Gamepad()
+
+    async def connect_vehicle(self):
+        """
+        Connect to the hub (and initialize it).
+        """
         await bricknil.initialize()
 
-        self.telemetry_store_map = {}
-        for name, peripheral in self.vehicle.peripherals.items():
-            peripheral_item = self.telemetry_store.append(None, [name, ''])
-            for cap in peripheral.capabilities:
-                cap_value = peripheral.value[cap] if peripheral.value != None else 'N/A'
-                cap_item = self.telemetry_store.append(peripheral_item, [ cap.name, str(cap_value) ])
-                self.telemetry_store_map[(peripheral, cap)] = cap_item
-            peripheral.connect('notify', self.on_vehicle_sensor_reading_changed)
+    async def disconnect_vehicle(self):
+        await bricknil.finalize()
+
+    def call_ui(self, func, *args):
+        """
+        Call `func` in UI (main) thread.
+        """
+        if self.control != None:
+            def call():
+                func(*args)
+                return False
+            GLib.idle_add(call)
+        else:
+            func(*args)
+
+    def show(self, page):
+        # Connect task may start before UI is built, "connecting"
+        # page is shown initially anyway.
+        if self.builder == None:
+            return
+        self.builder.get_object("content").set_visible_child(self.builder.get_object(page))
+
+    def clear_telemetry_view(self):
+        self.telemetry_store.clear()
+        self.telemetry_store_channels = {}
+
+    def add_telemetry_view(self, name, peripheral):
+        peripheral_item = self.telemetry_store.append(None, [name, ''])
+        cap_items = []
+        for cap in peripheral.capabilities:
+            cap_value = peripheral.value[cap] if peripheral.value != None else 'N/A'
+            cap_item = self.telemetry_store.append(peripheral_item, [ cap.name, str(cap_value) ])
+            cap_items.append(cap_item)
+            self.telemetry_store_channels[self.telemetry_store.get_string_from_iter(cap_item)] = (peripheral, cap, "%s.%s" % (name, cap.name))
+        return self.telemetry_updater(cap_items)
+
+    def telemetry_updater(self, cap_items):
+        """
+        Return bus subscriber updating given telemetry rows.
+        """
+        store = self.telemetry_store
+        def update(time, *cap_values):
+            for cap_item, cap_value in zip(cap_items, cap_values):
+                store[cap_item][1] = str(cap_value)
+        return update
+
+    def show_attitude(self, yaw, pitch, roll):
+        self.bearing.set_property("angle", yaw)
+        self.pitch.set_property("angle", pitch)
+        self.roll.set_property("angle", roll)
+
+    def show_stick(self, name, value):
+        self.keypad.set_property(name, value)
 
     def do_activate(self):
         window = self.builder.get_object("window")
         window.set_application(self)
         window.show_all()
+        self.startup.mark('window')
 
     def on_destroy(self, widget):
         self.on_quit(widget, None)
 
     def on_quit(self, widget, data):
         async def quit_task():
-            self.builder.get_object("content").set_visible_child(self.builder.get_object("shuttingdown"))
-            await bricknil.finalize()
-            self.quit()
-        spawn(quit_task())
+            await self.stop_session()
+            self.call_ui(self.quit)
+        self.show("shuttingdown")
+        self.spawn_control(quit_task(), 'quit')
 
     def on_calibrate(self, widget, data):
-        spawn(self.vehicle.steering_calibrate())
-
-    def on_debug(self, widget, data):
-    	import pdb
-    	pdb.set_trace()
-
-    def on_keypad_x_changed(self, widget, prop):
-        steering = widget.get_property(prop.name)
-        self.vehicle.set_property('steering', steering)
-
-    def on_keypad_y_changed(self, widget, prop):
-        speed = widget.get_property(prop.name)
-        self.vehicle.set_property('speed', speed)
-
-    def on_remote_x_changed(self, controller, prop):
-        v = self.controller.get_property(prop.name)
-        v = scale(v, (0, 255), (-100, 100))
-        self.vehicle.set_property('steering', v)
-        self.keypad.set_property("x", v)
+        self.spawn_control(self.vehicle.steering_calibrate(), 'calibrate')
 
-    def on_remote_y_changed(self, controller, prop):
-        v = self.controller.get_property(prop.name)
-        v = -1 * scale(v, (0, 255), (-100, 100))
-        self.vehicle.set_property('speed', v)
-        self.keypad.set_property("y", v)
-
-    def on_vehicle_sensor_reading_changed(self, peripheral):
-        for cap in peripheral.capabilities:
-            cap_item = self.telemetry_store_map[(peripheral, cap)]
-            cap_value = peripheral.value[cap]
-            self.telemetry_store[cap_item][1] = str(cap_value)
-        if peripheral == self.vehicle.position:
-            self.bearing.set_property("angle", peripheral.sense_pos[0])
-            self.pitch.set_property("angle", peripheral.sense_pos[1])
-            self.roll.set_property("angle", peripheral.sense_pos[2])
-
-    def on_connected(self, vehicle):
+    def on_record(self, action, state):
         """
-        Called when hub is connected
+        Start or stop recording telemetry to a file in current
+        directory.
         """
-        self.builder.get_object("content").set_visible_child(self.builder.get_object("initializing"))
-
-    def on_initialized(self, vehicle):
+        if state.get_boolean():
+            if not self.start_recording():
+                return
+        else:
+            self.stop_recording()
+        action.set_state(state)
+
+    def on_remote(self, action, state):
         """
-        Called when hub is initialized
+        Start or stop remote control server.
         """
-        self.builder.get_object("content").set_visible_child(self.builder.get_object("dashboard"))
+        if state.get_boolean():
+            self.start_remote()
+        else:
+            self.stop_remote()
+        action.set_state(state)
 
-        self.keypad.connect("notify::x", self.on_keypad_x_changed)
-        self.keypad.connect("notify::y", self.on_keypad_y_changed)
-
-        self.controller.connect("notify::abs-l-x", self.on_remote_x_changed)
-        self.controller.connect("notify::abs-r-y", self.on_remote_y_changed)
-
-    def on_disconnected(self, vehicle):
+    def on_publish(self, action, state):
         """
-        Called when hub disconnects.
+        Start or stop publishing telemetry to shared memory.
         """
-        spawn(self.connect_task())
+        action.set_state(state)
+        if state.get_boolean():
+            self.start_publishing(lambda: action.set_state(GLib.Variant.new_boolean(False)))
+        else:
+            self.stop_publishing()
 
+    def on_analyze(self, action, state):
+        """
+        Start or stop computing telemetry statistics (in worker processes
+        if there's more than one CPU). When stopped, print statistics of
+        the last analyzed batch.
+        """
+        if state.get_boolean():
+            self.start_analyzing()
+        else:
+            self.stop_analyzing()
+        action.set_state(state)
 
+    def on_battery_timer(self):
+        """
+        Show battery estimate in header bar
+        """
+        battery = self.stats.battery
+        if battery.initial_charge == battery.initial_charge:
+            subtitle = "4x4 Off-roader - battery %d%%" % (battery.remaining_fraction * 100)
+            runtime = battery.remaining_runtime
+            if runtime == runtime:
+                subtitle += " (%d:%02d left)" % (runtime // 3600, (runtime % 3600) // 60)
+            self.builder.get_object("header").set_subtitle(subtitle)
+        return GLib.SOURCE_CONTINUE
+
+    def on_profile(self, action, state):
+        """
+        Start or stop sampling profiler. When stopped, write samples from
+        last minute to a file in current directory (for flamegraph tools)
+        and print most frequently sampled functions.
+        """
+        if state.get_boolean():
+            threads = [threading.get_ident()]
+            if self.control != None:
+                threads.append(self.control.ident)
+            self.profiler = SamplingProfiler(threads)
+            self.profiler.start()
+            print("I: profiling")
+        else:
+            self.profiler.stop()
+            path = time.strftime("profile-%Y%m%d-%H%M%S.folded")
+            samples = self.profiler.write(path)
+            print("I: wrote %d samples to %s, hot functions:\n%s" % (samples, path, self.profiler.summary()))
+            self.profiler = None
+        action.set_state(state)
+
+    def on_profile_signal(self):
+        self.change_action_state("profile", GLib.Variant.new_boolean(self.profiler == None))
+        return GLib.SOURCE_CONTINUE
+
+    def on_keypad_moved(self, widget, steering, speed):
+        self.set_vehicle_property('steering', steering)
+        self.set_vehicle_property('speed', speed)
+
+    def on_telemetry_selection_changed(self, selection):
+        """
+        Show selected capability in the chart
+        """
+        model, item = selection.get_selected()
+        channel = None
+        if item != None:
+            channel = self.telemetry_store_channels.get(model.get_string_from_iter(item))
+        if channel != self.chart_channel:
+            self.chart_channel = channel
+            if self.chart_subscription != None:
+                self.bus.unsubscribe(self.chart_subscription)
+                self.chart_subscription = None
+            if channel != None:
+                self.chart.clear(datasets(channel[0], channel[1]))
+                self.chart_subscription = self.bus.subscribe(self.on_chart_channel_changed, channel[2])
+            else:
+                self.chart.clear(1)
+
+    def on_chart_channel_changed(self, time, value):
+        self.chart.add_sample(values(self.chart_channel[0], self.chart_channel[1]), time)
 
+    def on_initialized(self, vehicle):
+        VehicleSession.on_initialized(self, vehicle)
+        # Like controller, connect keypad only the first time.
+        if not self.keypad_connected:
+            self.keypad_connected = True
+            self.call_ui(self.keypad.connect, "moved", self.on_keypad_moved)
@@ -21,8 +21,11 @@
 import gi
 gi.require_version("Gdk", "3.0")
 gi.require_version("Gtk", "3.0")
-from gi.repository import GObject, Gtk, Gdk
-from math import pi
+from gi.repository import GObject, Gtk, Gdk, GLib
+from array import array
+from math import pi, inf, isfinite
+from sys import float_info
+import cairo
 
 def sgn(value):
     """
@@ -96,8 +99,21 @@ class XYPad(Gtk.Misc):
             raise AttributeError('unknown property %s' % prop.name)
 
 class Joystick(XYPad):
+    """
+    On-screen joystick controlled by mouse (drag) or arrow keys.
+
+    Besides `x` and `y` properties, joystick emits `moved` signal with
+    both values whenever user moves it. Pointer motion is compressed to
+    at most one update per frame and keyboard auto-repeat is ignored so
+    the rate of updates stays bounded. Unlike `notify::x` and `notify::y`,
+    `moved` is not emitted when properties are set programmatically.
+    """
     __gtype_name__ = 'Joystick'
 
+    __gsignals__ = {
+        "moved": (GObject.SignalFlags.RUN_FIRST, None, (int, int)),
+    }
+
     radius = 0.1
     padding = 5#px
 
@@ -113,7 +129,9 @@ class Joystick(XYPad):
         self._clickpoint_y = None
         self._circle_x = 0
         self._circle_y = 0
-        self._keys_pressed = []
+        self._keys_pressed = set()
+        self._pending = None
+        self._tick = None
 
     def do_set_property(self, prop, value):
         super().do_set_property(prop, value)
@@ -182,8 +200,8 @@ class Joystick(XYPad):
         self._clickpoint_y = None
         self._circle_x = 0
         self._circle_y = 0
-        self.set_property('x', 0)
-        self.set_property('y', 0)
+        self._pending = None
+        self._move(0, 0)
 
     def on_motion_notify_event(self, widget, event):
         if self._clickpoint_x != None:
@@ -201,43 +219,65 @@ class Joystick(XYPad):
             self._circle_x = x
             self._circle_y = y
             self.queue_draw()
-            if abs(self._x - x) > self._step_x:
-                self.set_property('x', x)
-            if abs(self._y - y) > self._step_y:
-                self.set_property('y', y)
+            # Only the last position before next frame is used
+            self._pending = (x, y)
+            if self._tick == None:
+                self._tick = self.add_tick_callback(self.on_tick)
+
+    def on_tick(self, widget, clock):
+        self._tick = None
+        if self._pending != None:
+            x, y = self._pending
+            self._pending = None
+            self._move(x, y)
+        return GLib.SOURCE_REMOVE
+
+    def _move(self, x, y):
+        """
+        Set both x and y and emit `moved` if any of them changed.
+        """
+        old = (self._x, self._y)
+        self.freeze_notify()
+        self.set_property('x', x)
+        self.set_property('y', y)
+        self.thaw_notify()
+        if (self._x, self._y) != old:
+            self.emit('moved', self._x, self._y)
 
     def on_key_press_event(self, widget, event):
         if event.keyval in (Gdk.KEY_Up, Gdk.KEY_Down, Gdk.KEY_Left, Gdk.KEY_Right):
-            if not event.keyval in self._keys_pressed:
-                self._keys_pressed.append(event.keyval)
+            if event.keyval in self._keys_pressed:
+                # Auto-repeat
+                return True
+            self._keys_pressed.add(event.keyval)
         if event.keyval == Gdk.KEY_Up:
             self._circle_y = 100
-            self.set_property('y', 100)
+            self._move(self._x, 100)
         elif event.keyval == Gdk.KEY_Down:
             self._circle_y = -100
-            self.set_property('y', -100)
+            self._move(self._x, -100)
         elif event.keyval == Gdk.KEY_Left:
             self._circle_x = -100
-            self.set_property('x', -100)
+            self._move(-100, self._y)
         elif event.keyval == Gdk.KEY_Right:
             self._circle_x = 100
-            self.set_property('x', 100)
+            self._move(100, self._y)
 
     def on_key_release_event(self, widget, event):
         if event.keyval in (Gdk.KEY_Up, Gdk.KEY_Down, Gdk.KEY_Left, Gdk.KEY_Right):
-            self._keys_pressed.remove(event.keyval)
+            self._keys_pressed.discard(event.keyval)
         if event.keyval == Gdk.KEY_Up:
             self._circle_y = 0
-            self.set_property('y', 0)
+            self._move(self._x, 0)
         elif event.keyval == Gdk.KEY_Down:
             self._circle_y = 0
-            self.set_property('y', 0)
+            self._move(self._x, 0)
         elif event.keyval == Gdk.KEY_Left:
             self._circle_x = 0
-            self.set_property('x', 0)
+            self._move(0, self._y)
         elif event.keyval == Gdk.KEY_Right:
             self._circle_x = 0
-            self.set_property('x', 0)
+            self._move(0, self._y)
 
     def _convert_absolute_to_relative(self,abs_val, abs_max):
         #import pdb
@@ -369,12 +409,282 @@ class BearingIndicator(AngleIndicator):
         cr.rotate(deg2rad(45))
         do_draw_visual_indication()
 
+class StripChart(Gtk.Misc):
+    """
+    Chart of one or more series of values scrolling over a time window.
+
+    Samples are decimated as they arrive: each pixel column keeps only
+    the minimum, maximum and last value of samples falling into it so both
+    memory and drawing cost depend on the width of the chart, not on the
+    sample rate. The chart is drawn into a cached surface which is
+    scrolled as the time passes and only columns that changed since last
+    frame are drawn.
+
+    Note, that resizing the widget discards the history.
+    """
+    __gtype_name__ = 'StripChart'
+
+    __gproperties__ = {
+        "window":   (float,  # type
+            "Window", # nick
+            "Time window (in seconds)", # blurb
+            0.1,  # min
+            3600.0, # max
+            10.0,  # default
+            GObject.ParamFlags.READWRITE), # flags
+        "minimum":   (float,  # type
+            "Minimum", # nick
+            "Value at the bottom of the chart", # blurb
+            -float_info.max,  # min
+            float_info.max, # max
+            0.0,  # default
+            GObject.ParamFlags.READWRITE), # flags
+        "maximum":   (float,  # type
+            "Maximum", # nick
+            "Value at the top of the chart", # blurb
+            -float_info.max,  # min
+            float_info.max, # max
+            100.0,  # default
+            GObject.ParamFlags.READWRITE), # flags
+        "autoscale":   (bool,  # type
+            "Autoscale", # nick
+            "Extend minimum / maximum when a value does not fit", # blurb
+            True,  # default
+            GObject.ParamFlags.READWRITE), # flags
+    }
+
+    # Colors of second, third... series, first one is drawn using
+    # foreground color.
+    colors = [ (0.9, 0.3, 0.2), (0.2, 0.7, 0.3), (0.2, 0.4, 0.9) ]
+
+    def __init__(self, series = 1, *args, **kwds):
+        super().__init__(*args, **kwds)
+        self.__window = 10.0
+        self.__minimum = 0.0
+        self.__maximum = 100.0
+        self.__autoscale = True
+        self.set_size_request(300, 100)
+        self._series = series
+        self._columns = 0
+        self._height = 0
+        self._surface = None
+        self._surface_back = None
+        self._reset(300)
+        self.add_tick_callback(self._on_tick)
+
+    def do_get_property(self, prop):
+        if prop.name == 'window':
+            return self.__window
+        elif prop.name == 'minimum':
+            return self.__minimum
+        elif prop.name == 'maximum':
+            return self.__maximum
+        elif prop.name == 'autoscale':
+            return self.__autoscale
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_set_property(self, prop, value):
+        if prop.name == 'window':
+            self.__window = value
+            self._reset(self._columns)
+        elif prop.name == 'minimum':
+            self.__minimum = value
+            self._redraw_all = True
+        elif prop.name == 'maximum':
+            self.__maximum = value
+            self._redraw_all = True
+        elif prop.name == 'autoscale':
+            self.__autoscale = value
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+        self.queue_draw()
+
+    def clear(self, series = None):
+        """
+        Discard all samples. If `series` is given, set number of series
+        to it.
+        """
+        if series != None:
+            self._series = series
+        self._reset(self._columns)
+        self.queue_draw()
+
+    def add_sample(self, values, time = None):
+        """
+        Add a sample, `values` is a sequence of values (one for each series).
+        `time` is in seconds of GLib monotonic time, if not given, current
+        time is used. NaNs are ignored.
+        """
+        if time == None:
+            time = GLib.get_monotonic_time() / 1000000
+        col = int(time / self._dt)
+        if col <= self._latest_col - self._columns:
+            # Late sample older than the window, its slot holds a newer
+            # column already.
+            return
+        slot = col % self._columns
+        base = slot * self._series
+        mins = self._mins
+        maxs = self._maxs
+        lasts = self._lasts
+        if self._cols[slot] != col:
+            self._cols[slot] = col
+            for i in range(self._series):
+                mins[base + i] = maxs[base + i] = lasts[base + i] = inf
+        for i, value in zip(range(self._series), values):
+            if not isfinite(value):
+                continue
+            lasts[base + i] = value
+            if mins[base + i] == inf:
+                mins[base + i] = maxs[base + i] = value
+            elif value < mins[base + i]:
+                mins[base + i] = value
+            elif value > maxs[base + i]:
+                maxs[base + i] = value
+            if self.__autoscale and not (self.__minimum <= value <= self.__maximum):
+                self._extend_range(value)
+        if col > self._latest_col:
+            self._latest_col = col
+        if self._dirty_col == None or col < self._dirty_col:
+            self._dirty_col = col
+        self._latest = values
+        if not self._draw_queued:
+            self._draw_queued = True
+            self.queue_draw()
+
+    def _reset(self, columns):
+        self._columns = max(1, columns)
+        self._dt = self.__window / self._columns
+        size = self._columns * self._series
+        self._cols = array('q', [-1]) * self._columns
+        self._mins = array('d', [inf]) * size
+        self._maxs = array('d', [inf]) * size
+        self._lasts = array('d', [inf]) * size
+        self._latest = None
+        self._latest_col = -1
+        self._surface_col = -1
+        self._dirty_col = None
+        self._draw_queued = False
+        self._redraw_all = True
+
+    def _extend_range(self, value):
+        span = self.__maximum - self.__minimum
+        if value < self.__minimum:
+            self.__minimum = value - 0.1 * span
+        else:
+            self.__maximum = value + 0.1 * span
+        self._redraw_all = True
+
+    def _on_tick(self, widget, frame_clock):
+        # Scroll chart as time passes even when there are no new samples.
+        if int(frame_clock.get_frame_time() / 1000000 / self._dt) != self._surface_col:
+            self.queue_draw()
+        return GLib.SOURCE_CONTINUE
+
+    def do_draw(self, cr):
+        self._draw_queued = False
+        bg_color = self.get_style_context().get_background_color(Gtk.StateFlags.NORMAL)
+        fg_color = self.get_style_context().get_color(Gtk.StateFlags.NORMAL)
+        allocation = self.get_allocation()
+        width = allocation.width
+        height = allocation.height
+
+        if width != self._columns or height != self._height or self._surface == None:
+            self._reset(width)
+            self._height = height
+            self._surface = cr.get_target().create_similar(cairo.CONTENT_COLOR_ALPHA, width, height)
+            self._surface_back = cr.get_target().create_similar(cairo.CONTENT_COLOR_ALPHA, width, height)
+
+        now_col = max(int(GLib.get_monotonic_time() / 1000000 / self._dt), self._latest_col)
+        shift = now_col - self._surface_col
+        if self._redraw_all or shift >= self._columns:
+            first_col = now_col - self._columns + 1
+        else:
+            if shift > 0:
+                # Scroll cached chart left by `shift` pixels
+                scr = cairo.Context(self._surface_back)
+                scr.set_operator(cairo.OPERATOR_SOURCE)
+                scr.set_source_surface(self._surface, -shift, 0)
+                scr.paint()
+                self._surface, self._surface_back = self._surface_back, self._surface
+            first_col = self._surface_col + 1
+            if self._dirty_col != None and self._dirty_col < first_col:
+                first_col = max(self._dirty_col, now_col - self._columns + 1)
+        self._draw_columns(first_col, now_col, bg_color, fg_color)
+        self._surface_col = now_col
+        self._dirty_col = None
+        self._redraw_all = False
+
+        cr.set_source_surface(self._surface, 0, 0)
+        cr.paint()
+
+        # Display range and current value(s)
+        cr.set_source_rgba(*list(fg_color))
+        cr.set_font_size(10)
+        cr.move_to(2, 10)
+        cr.show_text("%g" % self.__maximum)
+        cr.move_to(2, height - 2)
+        cr.show_text("%g" % self.__minimum)
+        if self._latest != None:
+            label = "  ".join("%.1f" % value for value in self._latest)
+            (x, y, w, h, dx, dy) = cr.text_extents(label)
+            cr.move_to(width - w - 2, 10)
+            cr.show_text(label)
+
+    def _draw_columns(self, first_col, last_col, bg_color, fg_color):
+        scr = cairo.Context(self._surface)
+        columns = self._columns
+        height = self._height
+        series = self._series
+        cols = self._cols
+        mins = self._mins
+        maxs = self._maxs
+        lasts = self._lasts
+        minimum = self.__minimum
+        scale = height / ((self.__maximum - minimum) or 1)
+
+        # Clear changed columns
+        x0 = columns - 1 - (last_col - first_col)
+        scr.set_operator(cairo.OPERATOR_SOURCE)
+        scr.set_source_rgba(*list(bg_color))
+        scr.rectangle(x0, 0, columns - x0, height)
+        scr.fill()
+        scr.set_operator(cairo.OPERATOR_OVER)
+
+        for i in range(series):
+            if i == 0:
+                scr.set_source_rgba(*list(fg_color))
+            else:
+                scr.set_source_rgb(*self.colors[(i - 1) % len(self.colors)])
+            prev = None
+            slot = (first_col - 1) % columns
+            if cols[slot] == first_col - 1 and lasts[slot * series + i] != inf:
+                prev = lasts[slot * series + i]
+            for col in range(first_col, last_col + 1):
+                slot = col % columns
+                index = slot * series + i
+                if cols[slot] != col or mins[index] == inf:
+                    prev = None
+                    continue
+                lo = mins[index]
+                hi = maxs[index]
+                # Connect to previous column so the line has no gaps
+                if prev != None:
+                    lo = min(lo, prev)
+                    hi = max(hi, prev)
+                prev = lasts[index]
+                y_top = height - (hi - minimum) * scale
+                y_bottom = height - (lo - minimum) * scale
+                scr.rectangle(columns - 1 - (last_col - col), y_top, 1, max(1, y_bottom - y_top))
+            scr.fill()
+
 if __name__ == '__main__':
     import sys
     from gi.repository import Gio
 
     class WidgetApp(Gtk.Application):
-        def __init__(self, widgetClass = KeyPad):
+        def __init__(self, widgetClass = Joystick):
             Gtk.Application.__init__(self,
                                      application_id="controlminus.ui.widget",
                                      flags=Gio.ApplicationFlags.FLAGS_NONE)
@@ -383,14 +693,32 @@ if __name__ == '__main__':
         def do_activate(self):
             window = Gtk.ApplicationWindow(application=self)
             widget = self.widgetClass()
-            widget.connect("notify::x", self.on_notify_xy)
-            widget.connect("notify::y", self.on_notify_xy)
+            if isinstance(widget, Joystick):
+                widget.connect("moved", self.on_moved)
+            elif isinstance(widget, XYPad):
+                widget.connect("notify::x", self.on_notify_xy)
+                widget.connect("notify::y", self.on_notify_xy)
+            if isinstance(widget, StripChart):
+                GLib.timeout_add(1, self.on_feed_chart, widget)
             window.add(widget)
             window.show_all()
 
+        def on_feed_chart(self, chart):
+            # Feed chart with a sine at ~50k samples per second
+            from math import sin
+            now = GLib.get_monotonic_time() / 1000000
+            for i in range(50):
+                t = now - (50 - i) / 50000
+                chart.add_sample((50 + 40 * sin(t), ), t)
+            return GLib.SOURCE_CONTINUE
+
+        def on_moved(self, widget, x, y):
+            print("I: moved to %d, %d" % (x, y))
+
         def on_notify_xy(self, widget, prop):
             print("I: %s changed to %s" % ( prop.name, widget.get_property(prop.name)))
 
     app = WidgetApp(Joystick)
     #app = WidgetApp(TiltIndicator)
+    #app = WidgetApp(StripChart)
     app.run(sys.argv)
\ No newline at end of file